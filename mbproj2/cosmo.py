@@ -46,6 +46,10 @@ class Cosmology(object):
         self.z = z
         self._lastparams = ()
 
+    def withRedshift(self, z):
+        """Return a copy of the cosmology at a different redshift."""
+        return Cosmology(z, H0=self.H0, WM=self.WM, WV=self.WV)
+
     def _calculate(self):
         """Recalculate distances if necessary."""
         params = (self.H0, self.WM, self.WV, self.z)
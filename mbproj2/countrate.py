@@ -19,20 +19,28 @@
 """Module to get count rates for temperatures, densities and
 metallicities.
 
-Results are taken from xspec, interpolating between results at fixed
-temperatures and metallicities
+Results are taken from xspec (or another backend, see ratebackend),
+interpolating between results at fixed temperatures and metallicities
+
+Tables are held in the process-wide memory cache (see tablecache), so
+they are shared by CountRate objects for the same settings and
+survive creating new CountRate objects, e.g. when Annuli are updated.
+If a table server is running (see tableserver), tables missing from
+memory are requested from it instead.
 """
 
 from __future__ import division, print_function, absolute_import
 
 import os.path
-import h5py
+from collections import OrderedDict
 
 import numpy as N
-import scipy.interpolate
 
+from .physconstants import kpc_cm
 from . import utils
-from .xspechelper import XSpecHelper
+from . import interptable
+from . import tablecache
+from . import ratebackend
 
 class CountRate:
     """Object caches count rates for temperatures, densities and
@@ -43,70 +51,602 @@ class CountRate:
     Tsteps = 100
     Tlogvals = N.linspace(N.log(Tmin), N.log(Tmax), Tsteps)
 
-    def __init__(self, cosmo):
-        """Initialise with cosmology."""
+    # If Ttolerance is set, count rate tables are built adaptively
+    # instead of using Tlogvals. The grid starts with Tcoarsesteps
+    # points, and intervals are split (up to Tmaxrefine times) where
+    # the fractional error in linear interpolation exceeds Ttolerance.
+    Ttolerance = None
+    Tcoarsesteps = 13
+    Tmaxrefine = 5
+
+    # object used to compute tables (see ratebackend module)
+    backend = ratebackend.getBackend()
+
+    # Optional grids of column density and redshift. If set, count
+    # rates are interpolated between tables computed at these values,
+    # so that the column density (e.g. as a fit parameter) or redshift
+    # can change without computing new tables. Values outside the
+    # grids are not allowed (see checkGridRange).
+    NHgrid_1022pcm2 = None
+    zgrid = None
+
+    # maximum number of stacked tables (combinations of bands) kept
+    # by each object
+    maxstacks = 16
+
+    # Single precision cannot represent rates per cm3 (or projected
+    # volumes in cm3), so single precision rates are per this volume
+    float32volume_cm3 = kpc_cm**3
+
+    def __init__(self, cosmo, NHgrid_1022pcm2=None, zgrid=None):
+        """Initialise with cosmology.
+
+        :param Cosmology cosmo: cosmology
+        :param NHgrid_1022pcm2: optional increasing grid of column densities to interpolate between
+        :param zgrid: optional increasing grid of redshifts to interpolate between
+        """
         self.cosmo = cosmo
-        self.ctcache = {}
-        self.fluxcache = {}
+        self.stackcache = OrderedDict()
+        self.fluxkeys = {}
+        self.normcache = {}
+        if NHgrid_1022pcm2 is not None:
+            self.NHgrid_1022pcm2 = NHgrid_1022pcm2
+        if zgrid is not None:
+            self.zgrid = zgrid
+
+    def __getstate__(self):
+        """Don't save cached tables when pickling (settings are kept)."""
+        state = dict(self.__dict__)
+        for name in ('stackcache', 'fluxkeys', 'normcache'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        """Start with empty caches when unpickling."""
+        self.__dict__.update(state)
+        self.stackcache = OrderedDict()
+        self.fluxkeys = {}
+        self.normcache = {}
+
+    def tableKeys(self, rmf, arf, minenergy_keV, maxenergy_keV, NH_1022):
+        """Return list of keys of tables needed to compute count rates
+        for the band and column density given."""
+
+        NHvals = (
+            [NH_1022] if self.NHgrid_1022pcm2 is None
+            else self.NHgrid_1022pcm2 )
+        zvals = [self.cosmo.z] if self.zgrid is None else self.zgrid
+        return [
+            (minenergy_keV, maxenergy_keV, z, NH, rmf, arf)
+            for NH in NHvals for z in zvals ]
+
+    def checkGridRange(self, NH_1022):
+        """Raise RuntimeError if the column density or redshift is
+        outside NHgrid_1022pcm2 or zgrid, as interpolation in the grids
+        would silently use the value at the end of the grid."""
+
+        for name, val, grid in (
+                ('column density', NH_1022, self.NHgrid_1022pcm2),
+                ('redshift', self.cosmo.z, self.zgrid)):
+            if grid is not None and not (grid[0] <= val <= grid[-1]):
+                raise RuntimeError(
+                    '%s %g is outside the grid (%g to %g)' % (
+                        name, val, grid[0], grid[-1]))
 
     def getCountRate(self, rmf, arf, minenergy_keV, maxenergy_keV,
                      NH_1022, T_keV, Z_solar, ne_cm3):
         """get count rate in counts per cm3 for parcel of gas between energies
         given."""
 
-        key = (minenergy_keV, maxenergy_keV, self.cosmo.z, NH_1022, rmf, arf)
+        return self.getCountRates(
+            [(rmf, arf, minenergy_keV, maxenergy_keV)],
+            NH_1022, T_keV, Z_solar, ne_cm3)[0]
 
-        if key not in self.ctcache:
-            self.addCountCache(key)
+    def getCountRates(self, bands, NH_1022, T_keV, Z_solar, ne_cm3,
+                      dtype=N.float64):
+        """Get count rates in counts per cm3 for several bands at once.
 
-        # evaluate interpolation functions for temperature given
-        a0, a1 = self.ctcache[key]
-        T_keV = N.clip(T_keV, self.Tmin, self.Tmax)
-        logT = N.log(T_keV)
-        Z0_ctrate = N.exp(N.interp(logT, self.Tlogvals, a0))
-        Z1_ctrate = N.exp(N.interp(logT, self.Tlogvals, a1))
+        The temperature bins are located once and the tables for all
+        the bands evaluated together.
 
-        # use Z=0 and Z=1 count rates to evaluate at Z given
-        return (Z0_ctrate + (Z1_ctrate-Z0_ctrate)*Z_solar)*ne_cm3**2
+        :param bands: list of (rmf, arf, minenergy_keV, maxenergy_keV) for each band
+        :param dtype: type of tables used (N.float32 for single precision tables, which should be used with single precision profiles)
+        :returns: array of rates with shape (len(bands), len(T_keV)) (per float32volume_cm3 rather than per cm3 if single precision)
+        """
+
+        gridded = self.NHgrid_1022pcm2 is not None or self.zgrid is not None
+        stackkey = (
+            tuple(bands),
+            NH_1022 if self.NHgrid_1022pcm2 is None else None,
+            dtype)
+        if stackkey not in self.stackcache:
+            self.addStackCache(stackkey, NH_1022)
+        axes, logtables = self.stackcache[stackkey]
+
+        logT = N.log(N.clip(T_keV, self.Tmin, self.Tmax))
+        if gridded:
+            self.checkGridRange(NH_1022)
+            logrates = utils.multilinearInterp(
+                logtables, axes, (NH_1022, self.cosmo.z, logT)).astype(
+                    dtype, copy=False)
+            norm = self._normFactor(self.cosmo.z)
+        else:
+            # single grid lookup for all the bands together
+            logrates = logtables(logT)
+            norm = 1.
+
+        rates = N.exp(logrates)
+        Z0_ctrate, Z1_ctrate = rates[:, 0], rates[:, 1]
+        return (Z0_ctrate + (Z1_ctrate-Z0_ctrate)*Z_solar)*(norm*ne_cm3**2)
+
+    def getCountRatesDerivs(self, bands, NH_1022, T_keV, Z_solar, ne_cm3):
+        """Get count rates for several bands, with their derivatives
+        with respect to log temperature and metallicity, from the same
+        tables as getCountRates.
+
+        The derivative with respect to log density is 2*rates. The
+        temperature derivative is zero outside the table range, where
+        temperatures are clipped.
+
+        :param bands: list of (rmf, arf, minenergy_keV, maxenergy_keV) for each band
+        :returns: rates, d(rates)/d(ln T_keV), d(rates)/d(Z_solar), each with shape (len(bands), len(T_keV))
+        """
+
+        gridded = self.NHgrid_1022pcm2 is not None or self.zgrid is not None
+        stackkey = (
+            tuple(bands),
+            NH_1022 if self.NHgrid_1022pcm2 is None else None,
+            N.float64)
+        if stackkey not in self.stackcache:
+            self.addStackCache(stackkey, NH_1022)
+        axes, logtables = self.stackcache[stackkey]
+
+        T_keV = N.asarray(T_keV, dtype=N.float64)
+        inside = (T_keV >= self.Tmin) & (T_keV <= self.Tmax)
+        logT = N.log(N.clip(T_keV, self.Tmin, self.Tmax))
+        if gridded:
+            self.checkGridRange(NH_1022)
+            coords = (NH_1022, self.cosmo.z, logT)
+            logrates = utils.multilinearInterp(logtables, axes, coords)
+            dlogrates = utils.multilinearInterp(
+                logtables, axes, coords, derivaxis=2)
+            norm = self._normFactor(self.cosmo.z)
+        else:
+            logrates, dlogrates = logtables.valueAndDerivative(logT)
+            norm = 1.
+
+        rates = N.exp(logrates)
+        drates = rates*dlogrates*inside
+        scale = norm*ne_cm3**2
+        return (
+            (rates[:, 0] + (rates[:, 1]-rates[:, 0])*Z_solar)*scale,
+            (drates[:, 0] + (drates[:, 1]-drates[:, 0])*Z_solar)*scale,
+            (rates[:, 1]-rates[:, 0])*scale,
+            )
+
+    def addStackCache(self, stackkey, NH_1022):
+        """Stack the log rate tables for several bands into a single
+        array with the band as the first dimension.
+
+        If the tables have different temperature grids, they are
+        resampled onto the union of the grids, which does not change
+        the linear interpolation."""
+
+        bands, NHkey, dtype = stackkey
+        bandkeys = [
+            self.tableKeys(*(tuple(band) + (NH_1022,))) for band in bands]
+        allkeys = [key for keys in bandkeys for key in keys]
+        # compute any missing tables together
+        ctables = self.warmCountCache(allkeys)
+
+        logTvals = N.unique(N.concatenate([
+            ctables[key][0] for key in allkeys]))
+
+        # change of volume units for single precision
+        logunit = 0. if dtype is N.float64 else N.log(self.float32volume_cm3)
+
+        if self.NHgrid_1022pcm2 is not None or self.zgrid is not None:
+            NHvals = N.unique(N.array([k[3] for k in allkeys], dtype=N.float64))
+            zvals = N.unique(N.array([k[2] for k in allkeys], dtype=N.float64))
+            tables = N.array([
+                self._gridLogTable(
+                    [ctables[k] for k in keys], keys, NHvals, zvals, logTvals)
+                for keys in bandkeys])
+            stack = ((NHvals, zvals, logTvals), (tables+logunit).astype(dtype))
+        else:
+            tables = N.array([
+                self._resampledLogTable(ctables[keys[0]], logTvals)
+                for keys in bandkeys])
+            stack = (
+                None,
+                interptable.makeGridTable(logTvals, tables+logunit).astype(dtype))
+
+        if len(self.stackcache) >= self.maxstacks:
+            self.stackcache.popitem(last=False)
+        self.stackcache[stackkey] = stack
+
+    def _resampledLogTable(self, ctable, logTvals):
+        """Return Z=0 and Z=1 log rates for the table (log
+        temperatures, log rates), linearly interpolated onto the log
+        temperatures given."""
+        tablelogT, logrates = ctable
+        if len(tablelogT) == len(logTvals) and N.all(tablelogT == logTvals):
+            return logrates
+        return interptable.makeGridTable(tablelogT, logrates)(logTvals)
+
+    def _normFactor(self, z):
+        """Dependence of count rates on distance at redshift given
+        (kept for each redshift, as computing distances is slow)."""
+        c = self.cosmo
+        if z == c.z:
+            # the cosmology keeps its distances
+            return (c.D_A * (1+z))**-2
+
+        key = (z, c.H0, c.WM, c.WV)
+        if key not in self.normcache:
+            self.normcache[key] = (c.withRedshift(z).D_A * (1+z))**-2
+        return self.normcache[key]
+
+    def _gridLogTable(self, ctables, keys, NHvals, zvals, logTvals):
+        """Make the table of log count rates with dimensions (Z, NH,
+        z, T) from the tables for the keys given for a band.
+
+        Rates are divided by the distance dependence, so that they
+        can be interpolated in redshift."""
+
+        logtable = N.zeros((2, len(NHvals), len(zvals), len(logTvals)))
+        for ctable, key in zip(ctables, keys):
+            i = N.searchsorted(NHvals, key[3])
+            j = N.searchsorted(zvals, key[2])
+            logtable[:, i, j, :] = (
+                self._resampledLogTable(ctable, logTvals) -
+                N.log(self._normFactor(key[2])))
+        return logtable
 
     def addCountCache(self, key):
         """Work out the counts for the temperature values for the key
         given.
         """
+        self.warmCountCache([key], workers=1)
+
+    def warmCountCache(self, keys, workers=None):
+        """Make sure the count rate tables for each of the keys are
+        available, computing any missing ones in parallel.
+
+        :param keys: list of (minenergy_keV, maxenergy_keV, z, NH_1022, rmf, arf)
+        :param workers: maximum number of xspec processes (default is the number of CPUs)
+        :returns: dict of (log temperatures, Z=0 and Z=1 log rates) for each key
+        """
+
+        memcache = tablecache.getMemoryCache()
+        out = {}
+        memkeys = {}
+        for key in set(keys):
+            memkeys[key] = self._memoryKey(key)
+            table = memcache.get(memkeys[key])
+            if table is not None:
+                out[key] = table
+        keys = [k for k in memkeys if k not in out]
+        if not keys:
+            return out
+
+        for minenergy_keV, maxenergy_keV, z, NH_1022, rmf, arf in keys:
+            if not os.path.exists(rmf):
+                raise RuntimeError('RMF %s does not exist' % rmf)
+            #if not os.path.exists(arf):
+            #    raise RuntimeError('ARF %s does not exist' % arf)
+
+        if self.useChannelTables():
+            # band tables are cheap to make from the channel tables
+            chantables = self.warmChannelCache(
+                [key[2:] for key in keys], workers=workers)
+            for key in keys:
+                out[key] = (
+                    CountRate.Tlogvals,
+                    N.log(self._bandFromChannels(key, chantables[key[2:]])))
+                memcache.put(memkeys[key], out[key])
+            return out
+
+        cached = self.storedCountTables(keys, workers=workers)
+        for key, c in zip(keys, cached):
+            # older entries were always on the standard grid
+            logTvals = c.get('logT', CountRate.Tlogvals)
+            out[key] = (logTvals, N.log(c['rates']))
+            memcache.put(memkeys[key], out[key])
+        return out
+
+    def storedCountTables(self, keys, workers=None):
+        """Get count rate tables from the table server or table cache,
+        computing and storing any missing ones.
+
+        :param keys: list of (minenergy_keV, maxenergy_keV, z, NH_1022, rmf, arf)
+        :param workers: maximum number of xspec processes
+        :returns: list of dicts of arrays (logT and rates) for each key
+        """
+
+        # imported here, so it can be run with python -m
+        from .tableserver import requestTables
+        tables = requestTables('countrate', self, keys)
+        if tables is not None:
+            return tables
+
+        store = tablecache.getDefaultCache()
+        hashkeys = [self._hashKey(key) for key in keys]
+        cached = [store.get(hashkey) for hashkey in hashkeys]
+
+        missing = [i for i, c in enumerate(cached) if c is None]
+        if missing:
+            misskeys = [keys[i] for i in missing]
+            store.checkCanCompute([self._tableMeta(k) for k in misskeys])
+            if self.Ttolerance is None:
+                logTvals = CountRate.Tlogvals
+                tables = [
+                    (logTvals, t) for t in self.backend.countRateTables(
+                        misskeys, N.exp(logTvals), self.cosmo,
+                        workers=workers)]
+            else:
+                tables = self._adaptiveCountTables(misskeys, workers)
+
+            for i, (logTvals, allZresults) in zip(missing, tables):
+                allZresults[allZresults < 1e-300] = 1e-300
+                cached[i] = {'logT': logTvals, 'rates': allZresults}
+                store.put(hashkeys[i], cached[i], meta=self._tableMeta(keys[i]))
+
+        return cached
+
+    def _memoryKey(self, key):
+        """Key in memory cache for count rate table key."""
+        if self.useChannelTables():
+            # made from the channel-resolved tables
+            return ('fromchannels', self._hashKey(key))
+        return self._hashKey(key)
+
+    def useChannelTables(self):
+        """Whether tables are made from channel-resolved rates.
+
+        This is done if the backend supports it, unless adaptive
+        temperature grids are requested."""
+        return self.backend.channelTables and self.Ttolerance is None
+
+    def warmChannelCache(self, chankeys, workers=None):
+        """Make sure the channel-resolved count rate tables are
+        available, computing any missing ones.
+
+        Tables of count rates in each channel are stored as the sum
+        over channels at or above each channel. The rate in a band is
+        then the difference of two values. Summing from the top keeps
+        the precision of hard bands at low temperatures, where the
+        rates are tiny compared to the total.
+
+        :param chankeys: list of (z, NH_1022, rmf, arf)
+        :param workers: maximum number of processes
+        :returns: dict of (channel centres, sums of rates) for each key
+        """
+
+        memcache = tablecache.getMemoryCache()
+        out = {}
+        hashkeys = {}
+        for chankey in set(chankeys):
+            hashkeys[chankey] = self._channelHashKey(chankey)
+            table = memcache.get(hashkeys[chankey])
+            if table is not None:
+                out[chankey] = table
+        chankeys = [k for k in hashkeys if k not in out]
+        if not chankeys:
+            return out
+
+        cached = self.storedChannelTables(chankeys, workers=workers)
+        for key, c in zip(chankeys, cached):
+            cent = 0.5*(c['chan_emin']+c['chan_emax'])
+            order = N.argsort(cent, kind='mergesort')
+            rates = c['rates'][..., order]
+            uppersum = N.zeros(rates.shape[:-1] + (rates.shape[-1]+1,))
+            uppersum[..., :-1] = N.cumsum(rates[..., ::-1], axis=-1)[..., ::-1]
+            out[key] = (cent[order], uppersum)
+            memcache.put(hashkeys[key], out[key])
+        return out
+
+    def storedChannelTables(self, chankeys, workers=None):
+        """Get channel-resolved count rate tables from the table
+        server or table cache, computing and storing any missing ones.
+
+        :param chankeys: list of (z, NH_1022, rmf, arf)
+        :param workers: maximum number of processes
+        :returns: list of dicts of arrays (chan_emin, chan_emax and rates) for each key
+        """
+
+        from .tableserver import requestTables
+        tables = requestTables('channelrate', self, chankeys)
+        if tables is not None:
+            return tables
+
+        store = tablecache.getDefaultCache()
+        hashkeys = [self._channelHashKey(key) for key in chankeys]
+        cached = [store.get(hashkey) for hashkey in hashkeys]
+
+        missing = [i for i, c in enumerate(cached) if c is None]
+        if missing:
+            store.checkCanCompute([
+                self._channelTableMeta(chankeys[i]) for i in missing])
+            tables = self.backend.channelRateTables(
+                [chankeys[i] for i in missing], N.exp(CountRate.Tlogvals),
+                self.cosmo, workers=workers)
+            for i, (chan_emin, chan_emax, rates) in zip(missing, tables):
+                cached[i] = {
+                    'chan_emin': chan_emin, 'chan_emax': chan_emax,
+                    'rates': rates}
+                store.put(
+                    hashkeys[i], cached[i],
+                    meta=self._channelTableMeta(chankeys[i]))
+
+        return cached
+
+    def _bandFromChannels(self, key, chantable):
+        """Rates for the band table key from the channel-resolved
+        table, selecting channels with centres inside the band.
+
+        :returns: array of Z=0 and Z=1 rates, shape (2, Tsteps)
+        """
+        minenergy_keV, maxenergy_keV = key[:2]
+        cent, uppersum = chantable
+        lo = N.searchsorted(cent, minenergy_keV, side='left')
+        hi = N.searchsorted(cent, maxenergy_keV, side='right')
+        return N.clip(uppersum[..., lo] - uppersum[..., hi], 1e-300, None)
+
+    def isTableCached(self, key):
+        """Is the count rate table for the key already available, in
+        memory or in the table cache?"""
+        memcache = tablecache.getMemoryCache()
+        if memcache.contains(self._memoryKey(key)):
+            return True
+        store = tablecache.getDefaultCache()
+        if self.useChannelTables():
+            chanhashkey = self._channelHashKey(key[2:])
+            return memcache.contains(chanhashkey) or store.contains(chanhashkey)
+        return store.contains(self._hashKey(key))
+
+    def _adaptiveCountTables(self, keys, workers):
+        """Compute count rate tables, refining the temperature grid
+        where linear interpolation in log space is inaccurate.
+
+        Starting from Tcoarsesteps points, the midpoint of each
+        interval is computed and the interval split if the rate at the
+        midpoint differs from the interpolated value by more than
+        Ttolerance (fractionally). This is repeated up to Tmaxrefine
+        times.
+
+        :returns: list of (log temperatures, rates) for each key
+        """
+
+        logTvals = [
+            N.linspace(N.log(self.Tmin), N.log(self.Tmax), self.Tcoarsesteps)
+            for key in keys]
+        rates = self.backend.countRateTables(
+            keys, [N.exp(lt) for lt in logTvals], self.cosmo, workers=workers)
+        rates = [N.clip(r, 1e-300, None) for r in rates]
+        # which intervals still need checking for each key
+        active = [N.ones(len(lt)-1, dtype=bool) for lt in logTvals]
+
+        for depth in range(self.Tmaxrefine):
+            todo = [i for i in range(len(keys)) if N.any(active[i])]
+            if not todo:
+                break
+
+            mids = [
+                (0.5*(logTvals[i][1:]+logTvals[i][:-1]))[active[i]]
+                for i in todo]
+            midrates = self.backend.countRateTables(
+                [keys[i] for i in todo], [N.exp(m) for m in mids],
+                self.cosmo, workers=workers)
+
+            for i, mid, midrate in zip(todo, mids, midrates):
+                midrate = N.clip(midrate, 1e-300, None)
+                logr = N.log(rates[i])
+                interp = 0.5*(logr[:, 1:]+logr[:, :-1])[:, active[i]]
+                err = N.abs(N.expm1(N.log(midrate)-interp)).max(axis=0)
+                split = err > self.Ttolerance
+
+                # insert points where interpolation is poor, marking
+                # the new intervals on either side for checking
+                lt = N.concatenate((logTvals[i], mid[split]))
+                r = N.concatenate((rates[i], midrate[:, split]), axis=1)
+                newactive = N.concatenate((
+                    N.zeros(len(logTvals[i]), dtype=bool),
+                    N.ones(N.count_nonzero(split), dtype=bool)))
+                order = N.argsort(lt)
+                logTvals[i], rates[i] = lt[order], r[:, order]
+                newactive = newactive[order]
+                # interval either side of each new point is active
+                active[i] = newactive[1:] | newactive[:-1]
+
+        return list(zip(logTvals, rates))
+
+    def _hashKey(self, key):
+        """Key in table cache for count rate table key.
 
+        This uses the contents of the response files, rather than
+        their names."""
         minenergy_keV, maxenergy_keV, z, NH_1022, rmf, arf = key
+        items = [
+            'countrate', self.backend.name,
+            float(minenergy_keV), float(maxenergy_keV), float(z), float(NH_1022),
+            tablecache.fileDigest(rmf), tablecache.fileDigest(arf),
+            self.cosmo.H0, self.cosmo.WM, self.cosmo.WV]
+        if self.Ttolerance is None:
+            items.append(CountRate.Tlogvals)
+        else:
+            items += [
+                'adaptive', self.Tmin, self.Tmax, self.Tcoarsesteps,
+                self.Tmaxrefine, self.Ttolerance]
+        return tablecache.hashKey(items)
 
-        if not os.path.exists(rmf):
-            raise RuntimeError('RMF %s does not exist' % rmf)
-        #if not os.path.exists(arf):
-        #    raise RuntimeError('ARF %s does not exist' % arf)
-
-        hdffile = 'countrate_cache.hdf5'
-
-        # nasty hack to stop concurrent access breaking
-        with utils.WithLock(hdffile + '.lockdir') as lock:
-            textkey = '_'.join(str(x) for x in key).replace('/', '@')
-            with h5py.File(hdffile) as f:
-                if textkey not in f:
-                    xspec = XSpecHelper()
-                    xspec.changeResponse(rmf, arf, minenergy_keV, maxenergy_keV)
-                    allZresults = []
-                    for Z_solar in (0., 1.):
-                        Zresults = []
-                        for Tlog in CountRate.Tlogvals:
-                            countrate = xspec.getCountsPerSec(
-                                NH_1022, N.exp(Tlog), Z_solar, self.cosmo, 1.)
-                            Zresults.append(countrate)
-                        Zresults = N.array(Zresults)
-                        Zresults[Zresults < 1e-300] = 1e-300
-                        allZresults.append(Zresults)
-                    xspec.finish()
-                    allZresults = N.array(allZresults)
-                    f[textkey] = allZresults
-                allZresults = N.array(f[textkey])
-
-        results = (N.log(allZresults[0]), N.log(allZresults[1]))
-        self.ctcache[key] = results
+    def _channelHashKey(self, chankey):
+        """Key in table cache for channel-resolved table key."""
+        z, NH_1022, rmf, arf = chankey
+        return tablecache.hashKey([
+            'channelrate', self.backend.name, float(z), float(NH_1022),
+            tablecache.fileDigest(rmf), tablecache.fileDigest(arf),
+            self.cosmo.H0, self.cosmo.WM, self.cosmo.WV, CountRate.Tlogvals])
+
+    def _tableMeta(self, key):
+        """Description of count rate table for bundle manifests and
+        error messages."""
+        minenergy_keV, maxenergy_keV, z, NH_1022, rmf, arf = key
+        meta = self._channelTableMeta(key[2:])
+        meta['kind'] = 'countrate'
+        meta['emin_keV'] = float(minenergy_keV)
+        meta['emax_keV'] = float(maxenergy_keV)
+        if self.Ttolerance is not None:
+            meta['Tgrid'] = 'adaptive %g-%g keV, tolerance %g' % (
+                self.Tmin, self.Tmax, self.Ttolerance)
+        return meta
+
+    def _channelTableMeta(self, chankey):
+        """Description of channel-resolved count rate table."""
+        z, NH_1022, rmf, arf = chankey
+        meta = self._cosmoMeta(z)
+        meta.update({
+            'kind': 'channelrate',
+            'NH_1022pcm2': float(NH_1022),
+            'rmf': rmf,
+            'rmf_sha1': tablecache.fileDigest(rmf),
+            'arf': arf,
+            'arf_sha1': tablecache.fileDigest(arf),
+            })
+        return meta
+
+    def _fluxTableMeta(self, eband):
+        """Description of flux table."""
+        meta = self._cosmoMeta(self.cosmo.z)
+        meta.update({
+            'kind': 'flux',
+            'emin_keV': float(eband[0]),
+            'emax_keV': float(eband[1]),
+            })
+        return meta
+
+    def _cosmoMeta(self, z):
+        """Description of table settings common to all tables."""
+        return {
+            'backend': self.backend.name,
+            'z': float(z),
+            'H0': self.cosmo.H0, 'WM': self.cosmo.WM, 'WV': self.cosmo.WV,
+            'Tgrid': '%g-%g keV, %i log steps' % (
+                CountRate.Tmin, CountRate.Tmax, CountRate.Tsteps),
+            }
+
+    def cacheKeys(self, keys=(), ebands=()):
+        """Return keys in the table cache of the tables needed for the
+        count rate table keys and flux energy bands given."""
+        out = set()
+        for key in keys:
+            if self.useChannelTables():
+                out.add(self._channelHashKey(key[2:]))
+            else:
+                out.add(self._hashKey(key))
+        for eband in ebands:
+            out.add(self._fluxHashKey(eband))
+        return out
 
     def getFlux(self, T_keV, Z_solar, ne_cm3, emin_keV=0.01, emax_keV=100.):
         """Get flux per cm3 in erg/cm2/s.
@@ -114,40 +654,123 @@ class CountRate:
         emin_keV and emax_keV are the energy range
         """
 
-        if (emin_keV, emax_keV) not in self.fluxcache:
-            self.makeFluxCache(emin_keV, emax_keV)
-        fluxcache = self.fluxcache[(emin_keV, emax_keV)]
-
-        if not self.fluxcache:
-            self.makeFluxCache()
+        fluxtable = self.warmFluxCache([(emin_keV, emax_keV)])[
+            (emin_keV, emax_keV)]
 
         logT = N.log( N.clip(T_keV, self.Tmin, self.Tmax) )
 
         # evaluate interpolation functions for temperature given
-        Z0_flux, Z1_flux = [f(logT) for f in fluxcache]
+        Z0_flux, Z1_flux = fluxtable(logT)
 
         # use Z=0 and Z=1 count rates to evaluate at Z given
         return (Z0_flux + (Z1_flux-Z0_flux)*Z_solar)*ne_cm3**2
 
+    def getFluxDerivs(self, T_keV, Z_solar, ne_cm3, emin_keV=0.01, emax_keV=100.):
+        """Get flux per cm3 in erg/cm2/s, with its derivatives with
+        respect to log temperature and metallicity.
+
+        :returns: flux, d(flux)/d(ln T_keV), d(flux)/d(Z_solar)
+        """
+
+        fluxtable = self.warmFluxCache([(emin_keV, emax_keV)])[
+            (emin_keV, emax_keV)]
+
+        T_keV = N.asarray(T_keV, dtype=N.float64)
+        inside = (T_keV >= self.Tmin) & (T_keV <= self.Tmax)
+        logT = N.log(N.clip(T_keV, self.Tmin, self.Tmax))
+        (Z0_flux, Z1_flux), (Z0_dflux, Z1_dflux) = (
+            fluxtable.valueAndDerivative(logT))
+
+        scale = ne_cm3**2
+        return (
+            (Z0_flux + (Z1_flux-Z0_flux)*Z_solar)*scale,
+            (Z0_dflux + (Z1_dflux-Z0_dflux)*Z_solar)*(scale*inside),
+            (Z1_flux-Z0_flux)*scale,
+            )
+
     def makeFluxCache(self, emin_keV, emax_keV):
         """Work out fluxes for the temperature grid points and response."""
+        self.warmFluxCache([(emin_keV, emax_keV)])
+
+    def warmFluxCache(self, ebands):
+        """Make sure flux tables are available for each of the energy
+        bands given.
+
+        Tables are loaded from the table cache, if possible, and any
+        missing ones are computed together using a single xspec.
+
+        :param ebands: list of (emin_keV, emax_keV)
+        :returns: dict of interpolating table for each energy band
+        """
+
+        memcache = tablecache.getMemoryCache()
+        out = {}
+        for eband in set(ebands):
+            table = memcache.get(self._fluxHashKey(eband))
+            if table is not None:
+                out[eband] = table
+        ebands = [e for e in set(ebands) if e not in out]
+        if not ebands:
+            return out
+
+        cached = self.storedFluxTables(ebands)
+
+        # store objects which interpolate the results from above
+        for eband, c in zip(ebands, cached):
+            out[eband] = interptable.UniformGridTable(
+                CountRate.Tlogvals[0], CountRate.Tlogvals[-1], c['fluxes'],
+                kind='cubic')
+            memcache.put(self._fluxHashKey(eband), out[eband])
+        return out
+
+    def storedFluxTables(self, ebands, workers=None):
+        """Get flux tables from the table server or table cache,
+        computing and storing any missing ones together using a
+        single xspec.
+
+        :param ebands: list of (emin_keV, emax_keV)
+        :param workers: unused
+        :returns: list of dicts of arrays (fluxes) for each band
+        """
+
+        from .tableserver import requestTables
+        tables = requestTables('flux', self, ebands)
+        if tables is not None:
+            return tables
+
+        store = tablecache.getDefaultCache()
+        hashkeys = [self._fluxHashKey(e) for e in ebands]
+        cached = [store.get(hashkey) for hashkey in hashkeys]
+
+        missing = [i for i, c in enumerate(cached) if c is None]
+        if missing:
+            store.checkCanCompute([self._fluxTableMeta(ebands[i]) for i in missing])
+            # we can work out the counts at other metallicities from two values
+            # we also work at a density of 1 cm^-3
+            tables = self.backend.fluxTables(
+                N.exp(CountRate.Tlogvals), self.cosmo,
+                [ebands[i] for i in missing])
+            for i, allZresults in zip(missing, tables):
+                cached[i] = {'fluxes': allZresults}
+                store.put(
+                    hashkeys[i], cached[i], meta=self._fluxTableMeta(ebands[i]))
+
+        return cached
+
+    def isFluxTableCached(self, eband):
+        """Is the flux table for (emin_keV, emax_keV) already available?"""
+        hashkey = self._fluxHashKey(eband)
+        return (
+            tablecache.getMemoryCache().contains(hashkey) or
+            tablecache.getDefaultCache().contains(hashkey))
 
-        xspec = XSpecHelper()
-        xspec.dummyResponse()
-        results = []
-        # we can work out the counts at other metallicities from two values
-        # we also work at a density of 1 cm^-3
-        for Z_solar in (0., 1.):
-            Zresults = []
-            for Tlog in CountRate.Tlogvals:
-                flux = xspec.getFlux(
-                    N.exp(Tlog), Z_solar, self.cosmo, 1.,
-                    emin_keV=emin_keV, emax_keV=emax_keV)
-                Zresults.append(flux)
-
-            # store functions which interpolate the results from above
-            results.append( scipy.interpolate.interpolate.interp1d(
-                CountRate.Tlogvals, N.array(Zresults), kind='cubic' ) )
-
-        xspec.finish()
-        self.fluxcache[(emin_keV, emax_keV)] = tuple(results)
+    def _fluxHashKey(self, eband):
+        """Key in table cache for flux table."""
+        # getFlux is called often, so remember the keys
+        if eband not in self.fluxkeys:
+            emin_keV, emax_keV = eband
+            self.fluxkeys[eband] = tablecache.hashKey((
+                'flux', self.backend.name, float(emin_keV), float(emax_keV),
+                float(self.cosmo.z), self.cosmo.H0, self.cosmo.WM,
+                self.cosmo.WV, CountRate.Tlogvals))
+        return self.fluxkeys[eband]
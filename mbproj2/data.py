@@ -27,18 +27,42 @@ from .physconstants import kpc_cm
 from . import utils
 from .utils import uprint
 from . import countrate
+from . import projection
+from . import tablecache
 
 class Annuli:
-    """Geometric information about the annuli on the sky."""
+    """Geometric information about the annuli on the sky.
 
-    def __init__(self, edges_arcmin, cosmology):
+    The derived quantities are shared with other Annuli with the same
+    edges, cosmology and projection, so should not be modified.
+    """
+
+    # attributes computed from the edges and cosmology
+    _derivednames = (
+        'geomarea_arcmin2', 'nshells', 'edges_cm', 'edges_kpc',
+        'edges_logkpc', 'rout_cm', 'rin_cm', 'midpt_cm', 'midpt_kpc',
+        'midpt_logkpc', 'massav_cm', 'massav_kpc', 'massav_logkpc',
+        'widths_cm', 'geomarea_cm2', 'vols_cm3', 'projector',
+        'projvols_cm3')
+
+    def __init__(self, edges_arcmin, cosmology, projection='dense',
+                 projbandwidth=None, shells=None):
         """
         :param edges_arcmin: edges of annuli in arcmin (if N annuli, should be N+1 edges)
 
         :param Cosmology cosmology: Cosmology object
 
+        :param projection: projection operator ('dense' or 'triangular', which is faster for large numbers of annuli; see projection module)
+
+        :param projbandwidth: for triangular projection, optionally only include shells up to this number of shells outside each annulus
+
+        :param shells: optional Annuli giving the shells of the model, if these are different from the annuli (e.g. a coarser grid, to speed up the model). The model should be constructed using these shells, and emission from them is projected onto these annuli.
+
         """
 
+        self.projection = projection
+        self.projbandwidth = projbandwidth
+        self.shells = shells
         self.update(edges_arcmin, cosmology)
 
     def __getstate__(self):
@@ -46,15 +70,32 @@ class Annuli:
         return {
             'edges_arcmin': self.edges_arcmin,
             'cosmology': self.cosmology,
+            'projection': self.projection,
+            'projbandwidth': self.projbandwidth,
+            'shells': self.shells,
+            'ctrate': self.ctrate,
             }
     def __setstate__(self, state):
         """Recalculate derived quantities when unpickling."""
+        self.projection = state.get('projection', 'dense')
+        self.projbandwidth = state.get('projbandwidth')
+        self.shells = state.get('shells')
+        if state.get('ctrate') is not None:
+            # keep count rate settings
+            self.ctrate = state['ctrate']
         self.update(state['edges_arcmin'], state['cosmology'])
 
     def update(self, edges_arcmin, cosmology):
         """Change the annuli.
         Useful for recalculating models with new grid.
 
+        Derived quantities are taken from the memory cache (see
+        tablecache) if Annuli with the same edges and cosmology have
+        been made before. The CountRate, with its settings and stacked
+        tables, is kept if the cosmology is unchanged. Count rate
+        tables are shared between CountRate objects by the memory
+        cache.
+
         :param edges_arcmin: edges of annuli in arcmin
         :param Cosmology cosmology: Cosmology object
         """
@@ -63,6 +104,32 @@ class Annuli:
         self.edges_arcmin = edges_arcmin
         self.cosmology = cosmology
 
+        c = cosmology
+        key = tablecache.hashKey([
+            'annuli', edges_arcmin, c.z, c.H0, c.WM, c.WV,
+            self.projection, self.projbandwidth,
+            None if self.shells is None else self.shells.edges_arcmin])
+        memcache = tablecache.getMemoryCache()
+        derived = memcache.get(key)
+        if derived is None:
+            self._calcDerived(edges_arcmin, cosmology)
+            derived = dict(
+                (n, getattr(self, n, None)) for n in self._derivednames)
+            memcache.put(key, derived)
+        else:
+            self.__dict__.update(derived)
+
+        # count rate helper (kept when only the edges change)
+        ctrate = getattr(self, 'ctrate', None)
+        if ctrate is None or (
+                (ctrate.cosmo.z, ctrate.cosmo.H0, ctrate.cosmo.WM,
+                 ctrate.cosmo.WV) != (c.z, c.H0, c.WM, c.WV)):
+            # copy, so that later changes to cosmology are noticed
+            self.ctrate = countrate.CountRate(c.withRedshift(c.z))
+
+    def _calcDerived(self, edges_arcmin, cosmology):
+        """Compute quantities derived from the edges and cosmology."""
+
         self.geomarea_arcmin2 = N.pi * (edges_arcmin[1:]**2 - edges_arcmin[:-1]**2)
         self.nshells = len(edges_arcmin) - 1
 
@@ -95,11 +162,19 @@ class Annuli:
         # volume of shells
         self.vols_cm3 = 4/3 * N.pi * (rout**3-rin**3)
 
-        # projected volumes
-        self.projvols_cm3 = utils.projectionVolumeMatrix(e)
-
-        # count rate helper (associated with cosmology)
-        self.ctrate = countrate.CountRate(cosmology)
+        # operator giving projected volumes (the dense matrix is
+        # only stored as projvols_cm3 for the dense projection)
+        shelledges_cm = None
+        if self.shells is not None:
+            shelledges_cm = (
+                cosmology.kpc_per_arcsec * self.shells.edges_arcmin * 60 * kpc_cm)
+        self.projector = projection.makeProjection(
+            e, kind=self.projection, bandwidth=self.projbandwidth,
+            shellradii_cm=shelledges_cm)
+        if self.projection == 'dense' or self.shells is not None:
+            self.projvols_cm3 = self.projector.toarray()
+        else:
+            self.projvols_cm3 = None
 
 def loadAnnuli(filename, cosmology, centrecol=0, hwcol=1):
     """Helper to load annuli from data file.
@@ -130,6 +205,45 @@ def expandlist(x, length):
     else:
         return N.full(length, float(x))
 
+def uniqueResponses(rmf, arf, nannuli):
+    """Find the distinct responses for a band.
+
+    :param rmf: response matrix filename, or list of filenames for each annulus
+    :param arf: ancillary response filename, or list of filenames for each annulus
+    :param nannuli: number of annuli
+    :returns: list of (rmf, arf), and array giving the index in this list for each annulus (None if there is only one response)
+    """
+
+    listtypes = (list, tuple, N.ndarray)
+    if not isinstance(rmf, listtypes) and not isinstance(arf, listtypes):
+        return [(rmf, arf)], None
+
+    rmfs = list(rmf) if isinstance(rmf, listtypes) else [rmf]*nannuli
+    arfs = list(arf) if isinstance(arf, listtypes) else [arf]*nannuli
+    if len(rmfs) != nannuli or len(arfs) != nannuli:
+        raise RuntimeError('Number of responses not same as number of annuli')
+
+    responses = []
+    respindex = N.zeros(nannuli, dtype=N.intp)
+    for i, resp in enumerate(zip(rmfs, arfs)):
+        if resp not in responses:
+            responses.append(resp)
+        respindex[i] = responses.index(resp)
+    return responses, respindex
+
+def contentKey(arrays):
+    """Copy arrays (or None), to check later with sameContent whether
+    their contents have changed."""
+    return tuple(None if a is None else N.array(a) for a in arrays)
+
+def sameContent(key, arrays):
+    """Whether arrays have the same contents as when contentKey was
+    called (comparing with the copies is much quicker than hashing)."""
+    return all(
+        (k is None and a is None) or (
+            k is not None and a is not None and N.array_equal(k, a))
+        for k, a in zip(key, arrays))
+
 class Band:
     """Count profile in a band."""
 
@@ -140,8 +254,8 @@ class Band:
         :param emin_keV: minimum energy of band in keV
         :param emax_keV: maximum energy of band in keV
         :param cts: numpy array of counts in each annulus
-        :param rmf: response matrix filename
-        :param arf: ancillary response matrix filename
+        :param rmf: response matrix filename, or list of filenames for each annulus
+        :param arf: ancillary response matrix filename, or list of filenames for each annulus
         :param exposures: numpy array of exposures in each annulus
 
         optionally:
@@ -155,6 +269,7 @@ class Band:
         self.cts = cts
         self.rmf = rmf
         self.arf = arf
+        self.responses, self.respindex = uniqueResponses(rmf, arf, len(cts))
         self.exposures = N.array(expandlist(exposures, len(cts)))
 
         if backrates is None:
@@ -168,6 +283,8 @@ class Band:
             self.areascales = N.array(areascales)
 
         self.psfmatrix = psfmatrix
+        self._psfprojcache = None
+        self._respopcache = None
 
     def calcProjProfileCmpts(self, annuli, ne_prof, T_prof, Z_prof, NH_1022pcm2, backscale=1.):
         """Return predicted cluster and background profiles (as tuples).
@@ -179,21 +296,134 @@ class Band:
         :para backscale: scaling factor for background
         """
 
-        rates = annuli.ctrate.getCountRate(
-            self.rmf, self.arf, self.emin_keV, self.emax_keV,
+        rates = annuli.ctrate.getCountRates(
+            [(rmf, arf, self.emin_keV, self.emax_keV)
+             for rmf, arf in self.responses],
             NH_1022pcm2, T_prof, Z_prof, ne_prof)
+        if self.respindex is None:
+            rates = rates[0]
+
+        return self.projectCountRates(annuli, rates, backscale=backscale)
 
-        projrates = annuli.projvols_cm3.dot(rates)
+    def projectCountRates(self, annuli, rates, backscale=1.):
+        """Return predicted cluster and background profiles (as
+        tuples), given count rates per cm3 in each shell.
 
-        if self.psfmatrix is not None:
-            projrates = self.psfmatrix.dot(projrates)
+        :param annuli: Annuli object
+        :param rates: count rates in each shell for this band, or for each response and shell if there are per-annulus responses
+        :para backscale: scaling factor for background
+        """
 
-        clustprof = projrates * self.areascales * self.exposures
-        backprof = (
-            self.backrates * backscale * annuli.geomarea_arcmin2 *
-            self.areascales * self.exposures )
+        op, backcts = self.responseOperator(annuli, dtype=rates.dtype)
+        if self.respindex is None:
+            clustprof = op.dot(rates)
+        else:
+            # counts detected in each annulus use the response for
+            # that annulus, so take the rates for that response
+            clustprof = N.empty(len(backcts), dtype=backcts.dtype)
+            for resprates, (rows, rowop) in zip(
+                    rates, self._responseRows(annuli, rates.dtype)):
+                clustprof[rows] = rowop.dot(resprates)
+
+        # keep the precision of the rates
+        return clustprof, backcts*backcts.dtype.type(backscale)
+
+    def projectCountRatesAdjoint(self, annuli, profgrad):
+        """Given derivatives of a statistic with respect to the
+        predicted cluster profile, return its derivatives with respect
+        to the count rates per cm3 (the transpose of projectCountRates).
+
+        :param annuli: Annuli object
+        :param profgrad: derivatives for each annulus
+        :returns: array with the same shape as the rates for projectCountRates
+        """
 
-        return clustprof, backprof
+        op = self.responseOperator(annuli)[0]
+        if self.respindex is None:
+            return op.dotT(profgrad)
+
+        return N.array([
+            rowop.dotT(profgrad[rows])
+            for rows, rowop in self._responseRows(annuli)])
+
+    def responseOperator(self, annuli, dtype=N.float64):
+        """Operator converting count rates per cm3 in each shell to
+        predicted counts in each annulus, combining the projection,
+        PSF, area scaling and exposure, and the background counts for
+        a background scaling of 1.
+
+        These are kept until the annuli are changed or the values of
+        the PSF matrix, exposures, area scales or background rates
+        change (including changes in place).
+
+        With a PSF, the operator is the dense product of the PSF and
+        projection matrices, even for a triangular projection, as the
+        PSF matrix is itself dense. It takes as much memory as the PSF
+        matrix.
+
+        :param dtype: type of values (N.float64 or N.float32, where the operator takes rates per CountRate.float32volume_cm3)
+        :returns: operator (see projection module), background counts
+        """
+        arrays = (
+            annuli.geomarea_arcmin2, self.psfmatrix, self.areascales,
+            self.exposures, self.backrates)
+        cache = getattr(self, '_respopcache', None)
+        if (cache is None or cache[0][0] is not annuli.projector or
+                not sameContent(cache[0][1], arrays)):
+            scale = self.areascales * self.exposures
+            if self.psfmatrix is None:
+                op = annuli.projector.rowScaled(scale)
+            else:
+                op = projection.MatrixOperator(
+                    self.psfmatrix.dot(annuli.projector.toarray()) *
+                    scale[:, N.newaxis])
+            backcts = self.backrates * annuli.geomarea_arcmin2 * scale
+            cache = self._respopcache = (
+                (annuli.projector, contentKey(arrays)),
+                {N.float64: (op, backcts)})
+
+        ops = cache[1]
+        dtype = N.dtype(dtype).type
+        if dtype not in ops:
+            # single precision rates are per float32volume_cm3
+            op, backcts = ops[N.float64]
+            unit = countrate.CountRate.float32volume_cm3
+            ops[dtype] = (
+                op.rowScaled(N.full(len(backcts), 1/unit)).astype(dtype),
+                backcts.astype(dtype))
+        return ops[dtype]
+
+    def _responseRows(self, annuli, dtype=N.float64):
+        """For per-annulus responses, get the annuli using each
+        response and the rows of the response operator for them, which
+        are kept with the operator.
+
+        :returns: list of (indices of annuli, MatrixOperator) for each response
+        """
+        op = self.responseOperator(annuli, dtype=dtype)[0]
+        ops = self._respopcache[1]
+        key = ('rows', N.dtype(dtype).type)
+        if key not in ops:
+            matrix = op.toarray()
+            ops[key] = [
+                (rows, projection.MatrixOperator(matrix[rows]))
+                for rows in (
+                    N.nonzero(self.respindex == i)[0]
+                    for i in range(len(self.responses)))]
+        return ops[key]
+
+    def projectionMatrix(self, annuli):
+        """Matrix converting emission in each shell to that detected
+        in each annulus (including the PSF, if any)."""
+        if self.psfmatrix is None:
+            return annuli.projector.toarray()
+        cache = getattr(self, '_psfprojcache', None)
+        if (cache is None or cache[0] is not annuli.projector or
+                not sameContent(cache[1], (self.psfmatrix,))):
+            cache = self._psfprojcache = (
+                annuli.projector, contentKey((self.psfmatrix,)),
+                self.psfmatrix.dot(annuli.projector.toarray()))
+        return cache[2]
 
     def calcProjProfile(self, annuli, ne_prof, T_prof, Z_prof, NH_1022pcm2, backscale=1.):
         """Predict profile given cluster profiles.
@@ -229,13 +459,218 @@ def loadBand(
     return Band(emin_keV, emax_keV, cts, rmf, arf, exps, areascales=areascales)
 
 class Data:
-    """Dataset class."""
+    """Dataset class.
 
-    def __init__(self, bands, annuli):
+    The counts, exposures, area scales and background rates of the
+    bands are kept in (nbands, nannuli) arrays (the attributes cts,
+    exposures, areascales and backrates), and those of each Band are
+    views of its row. If the arrays of a band are replaced, they are
+    copied into the stacked arrays when these are next used.
+    """
+
+    # band arrays which are stacked
+    _stacked = ('cts', 'exposures', 'areascales', 'backrates')
+
+    def __init__(self, bands, annuli, NH_1022pcm2=None, dtype=N.float64):
         """
         bands: list of Band objects
         annuli: Annuli object
+        NH_1022pcm2: if set, compute count rate tables for this column density
+        dtype: type used for count rates and predicted profiles (N.float32 halves the memory traffic, at some cost in accuracy; see Fit.compareFloat32)
         """
         
         self.bands = bands
         self.annuli = annuli
+        self.dtype = N.dtype(dtype).type
+        self.stackBands()
+
+        if NH_1022pcm2 is not None:
+            self.warmCountRates(NH_1022pcm2)
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        # views are pickled as copies, so restore them
+        self.stackBands()
+
+    def stackBands(self):
+        """Copy the counts, exposures, area scales and background rates
+        of the bands into (nbands, nannuli) arrays, replacing those of
+        the bands with views into them."""
+
+        nannuli = set(len(b.cts) for b in self.bands)
+        if len(nannuli) > 1:
+            raise RuntimeError('Bands have different numbers of annuli')
+
+        for name in self._stacked:
+            stacked = N.array(
+                [getattr(b, name) for b in self.bands], dtype=N.float64)
+            setattr(self, name, stacked)
+            for band, row in zip(self.bands, stacked):
+                setattr(band, name, row)
+        self._stackopcache = None
+        self._cashlike = None
+
+    def updateStacked(self):
+        """Restack the band arrays if any have been replaced since they
+        were stacked."""
+        for name in self._stacked:
+            stacked = getattr(self, name)
+            for band in self.bands:
+                if getattr(band, name).base is not stacked:
+                    self.stackBands()
+                    return
+
+    def calcCountRates(self, ne_prof, T_prof, Z_prof, NH_1022pcm2):
+        """Compute count rates per cm3 in each shell for all the bands.
+
+        The tables for all the bands and their responses are evaluated
+        together.
+
+        :returns: list of count rates for each band, with shape (nshells,), or (nresponses, nshells) for bands with per-annulus responses (a (nbands, nshells) array if no band has per-annulus responses)
+        """
+
+        dtype = getattr(self, 'dtype', N.float64)
+        if dtype is not N.float64:
+            ne_prof, T_prof, Z_prof = [
+                N.asarray(x, dtype=dtype) for x in (ne_prof, T_prof, Z_prof)]
+
+        rows, bandslices = self._tableRows()
+        rates = self.annuli.ctrate.getCountRates(
+            rows, NH_1022pcm2, T_prof, Z_prof, ne_prof, dtype=dtype)
+        if bandslices == list(range(len(rates))):
+            # one row for each band, so already stacked
+            return rates
+        return [rates[sl] for sl in bandslices]
+
+    def cashLikelihood(self):
+        """Return utils.CashLikelihood for the counts of all the bands,
+        which takes (nbands, nannuli) profiles.
+
+        This is kept until the band arrays are restacked, so call
+        stackBands after modifying the counts in place."""
+        self.updateStacked()
+        if getattr(self, '_cashlike', None) is None:
+            self._cashlike = utils.CashLikelihood(self.cts)
+        return self._cashlike
+
+    def projectCountRates(self, rates, backscale=1.):
+        """Return predicted cluster and background profiles for all
+        the bands, given their count rates per cm3 in each shell.
+
+        The bands without a PSF or per-annulus responses are projected
+        together, with one product of the projection operator and
+        their rates.
+
+        :param rates: count rates for each band, as returned by calcCountRates
+        :param backscale: scaling factor for background
+        :returns: cluster and background profiles, as (nbands, nannuli) arrays
+        """
+
+        self.updateStacked()
+        annuli = self.annuli
+        dtype = rates[0].dtype.type
+        clustprofs = N.empty(self.cts.shape, dtype=dtype)
+        backprofs = N.empty(self.cts.shape, dtype=dtype)
+
+        stacked = []
+        for i, band in enumerate(self.bands):
+            if band.psfmatrix is None and band.respindex is None:
+                stacked.append(i)
+            else:
+                clustprofs[i], backprofs[i] = band.projectCountRates(
+                    annuli, rates[i], backscale=backscale)
+
+        if stacked:
+            if len(stacked) == len(self.bands) and isinstance(rates, N.ndarray):
+                srates = rates
+            else:
+                srates = N.array([rates[i] for i in stacked])
+            op, scale, backcts = self._stackedResponse(stacked, dtype)
+            clustprofs[stacked] = op.dot(srates.T).T * scale
+            backprofs[stacked] = backcts * dtype(backscale)
+
+        return clustprofs, backprofs
+
+    def _stackedResponse(self, stacked, dtype):
+        """Get the projection operator, the area scaling times exposure
+        and the background counts (for a background scaling of 1) for
+        the bands projected together.
+
+        The operator is the annuli's projector, so a triangular
+        projection keeps its packed or banded storage and applies it to
+        each band, while a dense or rectangular projection multiplies
+        all the bands by its matrix at once. Single precision operators
+        take rates per CountRate.float32volume_cm3.
+
+        These are kept until the annuli are changed, the bands are
+        restacked or the values of the exposures, area scales or
+        background rates change (including changes in place).
+
+        :param stacked: indices of bands
+        :param dtype: type of values
+        :returns: projection operator, (nstacked, nannuli) scale and background counts
+        """
+
+        annuli = self.annuli
+        arrays = (
+            annuli.geomarea_arcmin2, self.areascales, self.exposures,
+            self.backrates)
+        cache = getattr(self, '_stackopcache', None)
+        if (cache is None or cache[0][0] is not annuli.projector or
+                cache[0][1] != tuple(stacked) or
+                not sameContent(cache[0][2], arrays)):
+            cache = self._stackopcache = (
+                (annuli.projector, tuple(stacked), contentKey(arrays)), {})
+
+        if dtype not in cache[1]:
+            op = annuli.projector
+            if dtype is not N.float64:
+                op = op.rowScaled(N.full(
+                    len(annuli.geomarea_arcmin2),
+                    1/countrate.CountRate.float32volume_cm3)).astype(dtype)
+            scale = self.areascales[stacked] * self.exposures[stacked]
+            backcts = self.backrates[stacked] * annuli.geomarea_arcmin2 * scale
+            cache[1][dtype] = (op, scale.astype(dtype), backcts.astype(dtype))
+        return cache[1][dtype]
+
+    def calcCountRatesDerivs(self, ne_prof, T_prof, Z_prof, NH_1022pcm2):
+        """Compute count rates per cm3 in each shell for all the bands,
+        with their derivatives with respect to log temperature and
+        metallicity.
+
+        :returns: lists of rates, d(rates)/d(ln T_keV) and d(rates)/d(Z_solar) for each band, with shapes as calcCountRates
+        """
+        rows, bandslices = self._tableRows()
+        allrates = self.annuli.ctrate.getCountRatesDerivs(
+            rows, NH_1022pcm2, T_prof, Z_prof, ne_prof)
+        return [[r[sl] for sl in bandslices] for r in allrates]
+
+    def _tableRows(self):
+        """Get count rate table rows needed for the bands.
+
+        :returns: list of (rmf, arf, minenergy_keV, maxenergy_keV), and the index or slice of rows for each band
+        """
+        rows = []
+        bandslices = []
+        for b in self.bands:
+            start = len(rows)
+            rows += [
+                (rmf, arf, b.emin_keV, b.emax_keV) for rmf, arf in b.responses]
+            bandslices.append(
+                start if b.respindex is None else slice(start, len(rows)))
+        return rows, bandslices
+
+    def warmCountRates(self, NH_1022pcm2, workers=None):
+        """Compute any missing count rate tables for the bands, using
+        several xspec processes at the same time.
+
+        :param NH_1022pcm2: absorbing column density
+        :param workers: maximum number of xspec processes (default is number of CPUs)
+        """
+        ctrate = self.annuli.ctrate
+        keys = []
+        for b in self.bands:
+            for rmf, arf in b.responses:
+                keys += ctrate.tableKeys(
+                    rmf, arf, b.emin_keV, b.emax_keV, NH_1022pcm2)
+        ctrate.warmCountCache(keys, workers=workers)
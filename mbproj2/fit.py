@@ -54,9 +54,35 @@ class Fit:
         self.model = model
         self.data = data
         self.refreshThawed()
+
+        # build any missing count rate tables in parallel
+        if data is not None:
+            if 'NH_1022pcm2' in pars:
+                self._checkNHGrid()
+            data.warmCountRates(model.computeNH(pars))
         self._veuszembed = []
         self.bestlike = -1e99
 
+    def _checkNHGrid(self):
+        """Check the column density parameter stays within the grid of
+        column densities of the count rate tables."""
+
+        par = self.pars['NH_1022pcm2']
+        grid = self.data.annuli.ctrate.NHgrid_1022pcm2
+        if grid is None:
+            raise RuntimeError(
+                'NH_1022pcm2 parameter requires CountRate.NHgrid_1022pcm2')
+        if par.frozen:
+            minval = maxval = par.val
+        else:
+            minval = getattr(par, 'minval', -N.inf)
+            maxval = getattr(par, 'maxval', N.inf)
+        if minval < grid[0] or maxval > grid[-1]:
+            raise RuntimeError(
+                'NH_1022pcm2 parameter range (%g to %g) is outside '
+                'CountRate.NHgrid_1022pcm2 (%g to %g): set its minval '
+                'and maxval' % (minval, maxval, grid[0], grid[-1]))
+
     def refreshThawed(self):
         """Call this after making changes to which parameters are thawed."""
         self.thawed = [
@@ -64,6 +90,8 @@ class Fit:
 
     def calcProfiles(self):
         """Predict model profiles for each band.
+
+        :returns: (nbands, nannuli) array of profiles
         """
 
         ne_prof, T_prof, Z_prof = self.model.computeProfs(self.pars)
@@ -74,26 +102,67 @@ class Fit:
         else:
             backscale = 1.
 
-        profs = []
-        for band in self.data.bands:
-            modprof = band.calcProjProfile(
-                self.data.annuli, ne_prof, T_prof, Z_prof,
-                self.model.NH_1022pcm2,
-                backscale=backscale)
-            profs.append(modprof)
+        # count rates for all bands, evaluated together
+        rates = self.data.calcCountRates(
+            ne_prof, T_prof, Z_prof, self.model.computeNH(self.pars))
 
-        return profs
+        clustprofs, backprofs = self.data.projectCountRates(
+            rates, backscale=backscale)
+        return clustprofs+backprofs
+
+    def calcLikeProfileDerivs(self):
+        """Compute the likelihood (excluding priors) and its
+        derivatives with respect to the log density, log temperature
+        and metallicity in each shell.
+
+        This costs about one extra likelihood evaluation. Derivatives
+        with respect to parameters follow from these by the chain rule
+        through the model components.
+
+        :returns: likelihood, dict of derivatives with keys 'logne', 'logT' and 'Z' (natural logs)
+        """
+
+        ne_prof, T_prof, Z_prof = self.model.computeProfs(self.pars)
+
+        if 'backscale' in self.pars:
+            backscale = self.pars['backscale'].val
+        else:
+            backscale = 1.
+
+        annuli = self.data.annuli
+        allrates, alldlogT, alldZ = self.data.calcCountRatesDerivs(
+            ne_prof, T_prof, Z_prof, self.model.computeNH(self.pars))
+
+        # combine any responses for each shell
+        def shellsum(x):
+            return x.reshape(-1, x.shape[-1]).sum(axis=0)
+
+        predprofs = []
+        derivs = {'logne': 0., 'logT': 0., 'Z': 0.}
+        for band, rates, dlogT, dZ in zip(
+                self.data.bands, allrates, alldlogT, alldZ):
+            clustprof, backprof = band.projectCountRates(
+                annuli, rates, backscale=backscale)
+            predprof = clustprof+backprof
+            predprofs.append(predprof)
+
+            # derivatives of likelihood with respect to rates
+            ratederiv = band.projectCountRatesAdjoint(
+                annuli, utils.cashLogLikelihoodGrad(band.cts, predprof))
+
+            derivs['logne'] = derivs['logne'] + shellsum(2*ratederiv*rates)
+            derivs['logT'] = derivs['logT'] + shellsum(ratederiv*dlogT)
+            derivs['Z'] = derivs['Z'] + shellsum(ratederiv*dZ)
+
+        return self.likeFromProfs(predprofs), derivs
 
     def likeFromProfs(self, predprofs):
         """Given predicted profiles, calculate log likelihood
         (excluding prior).
 
-        :param list[numpy.array] predprofs: input profiles
+        :param numpy.array predprofs: input profiles for each band, shape (nbands, nannuli)
         """
-        likelihood = 0.
-        for band, predprof in zip(self.data.bands, predprofs):
-            likelihood += utils.cashLogLikelihood(band.cts, predprof)
-        return likelihood
+        return self.data.cashLikelihood()(predprofs)
 
     def thawedParVals(self):
         """Return list of numeric values of thawed parameters."""
@@ -139,6 +208,38 @@ class Fit:
 
         return totlike
 
+    def compareFloat32(self, samples=None):
+        """Compare the likelihood computed in single precision (see
+        Data) with double precision, to check whether single
+        precision is accurate enough.
+
+        :param samples: optional list of thawed parameter values to compare at (e.g. from a chain), otherwise use the current parameters
+        :returns: maximum absolute difference in log likelihood
+        """
+
+        origvals = self.thawedParVals()
+        origdtype = self.data.dtype
+        if samples is None:
+            samples = [origvals]
+
+        maxdiff = 0.
+        try:
+            for vals in samples:
+                self.updateThawed(vals)
+                likes = []
+                for dtype in (N.float64, N.float32):
+                    self.data.dtype = dtype
+                    likes.append(self.likeFromProfs(self.calcProfiles()))
+                maxdiff = max(maxdiff, abs(likes[1]-likes[0]))
+        finally:
+            self.data.dtype = origdtype
+            self.updateThawed(origvals)
+
+        uprint(
+            'Maximum difference in log likelihood between single and '
+            'double precision: %.3g (%i samples)' % (maxdiff, len(samples)))
+        return maxdiff
+
     def doFitting(self, silent=False, maxiter=10):
         """Optimize parameters to increase likelihood.  Uses scipy's
         Nelder-Mead and Powell optimizers, repeating if a new minimum
@@ -122,7 +122,10 @@ def initialNeCmptBinnedFromBeta(
 
 def autoRadialBins(annuli, data, minsn, minbins=2, maxbins=100):
     """Take radial count profiles and choose bins using number of
-    projected counts."""
+    projected counts.
+
+    :param annuli: Annuli of the count profiles (data.annuli, if the model uses different shells)
+    """
 
     ninbins = len(annuli.massav_cm)
 
@@ -191,7 +194,9 @@ def initialNeCmptInterpolMoveRadFromBeta(
         rlog = N.linspace(rlogannuli[0], rlogannuli[-1], nradbins)
         nbins = nradbins
     elif mode == 'minsn':
-        rlog = autoRadialBins(annuli, data, minsn, minbins=minbins, maxbins=maxbins)
+        # bins follow the count profiles (the model shells may differ)
+        rlog = autoRadialBins(
+            data.annuli, data, minsn, minbins=minbins, maxbins=maxbins)
         nbins = len(rlog)
     else:
         raise ValueError('Invalid mode')
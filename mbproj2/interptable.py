@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Fast interpolation of tabulated values.
+
+The tables used for count rates and fluxes are evaluated inside every
+likelihood evaluation, so these avoid binary searches and
+constructing interpolation objects by using the known grid spacing to
+compute the index directly. Polynomial coefficients for each interval
+are precomputed, so that a lookup is a few multiply-adds.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import copy
+
+import numpy as N
+import scipy.interpolate
+
+class _PolyTable:
+    """Base class for tables using polynomials in each interval.
+
+    Subclasses set coeffs, with shape (..., nintervals, order+1), and
+    implement locate and invWidth.
+    """
+
+    def locate(self, x):
+        """Return interval index and fractional position in the
+        interval for the values x (clipped to the grid)."""
+        raise NotImplementedError
+
+    def invWidth(self, idx):
+        """Return inverse width of intervals with indices given."""
+        raise NotImplementedError
+
+    def evaluate(self, idx, t):
+        """Evaluate tables given interval indices and fractional
+        positions from locate.
+
+        :returns: array with shape of leading table dimensions + shape of idx
+        """
+        c = self.coeffs[..., idx, :]
+        # keep the precision of the table
+        t = t.astype(c.dtype, copy=False)
+        out = c[..., -1]
+        for i in range(c.shape[-1]-2, -1, -1):
+            out = out*t + c[..., i]
+        return out
+
+    def evaluateDerivative(self, idx, t):
+        """Evaluate derivative of tables with respect to the
+        fractional position t."""
+        c = self.coeffs[..., idx, :]
+        t = t.astype(c.dtype, copy=False)
+        order = c.shape[-1]-1
+        out = order*c[..., -1]
+        for i in range(order-1, 0, -1):
+            out = out*t + i*c[..., i]
+        return out
+
+    def astype(self, dtype):
+        """Return copy of table with values of the type given (e.g.
+        N.float32). Positions are still located in double precision."""
+        out = copy.copy(self)
+        out.values = self.values.astype(dtype)
+        out.coeffs = self.coeffs.astype(dtype)
+        return out
+
+    def __call__(self, x):
+        """Interpolate tables at values x (any shape)."""
+        idx, t = self.locate(x)
+        return self.evaluate(idx, t)
+
+    def valueAndDerivative(self, x):
+        """Interpolate tables and their derivatives with respect to x
+        at values x. The derivative is zero outside the grid, where
+        the values are clipped.
+
+        :returns: values, derivatives
+        """
+        x = N.asarray(x, dtype=N.float64)
+        idx, t = self.locate(x)
+        inside = (x >= self.xmin) & (x <= self.xmax)
+        deriv = self.evaluateDerivative(idx, t)
+        deriv = deriv * (self.invWidth(idx)*inside).astype(
+            deriv.dtype, copy=False)
+        return self.evaluate(idx, t), deriv
+
+class UniformGridTable(_PolyTable):
+    """Interpolate values tabulated on a uniform grid."""
+
+    def __init__(self, xmin, xmax, values, kind='linear'):
+        """
+        :param xmin: first grid value
+        :param xmax: last grid value
+        :param values: array of values with shape (..., ngrid), where the leading dimensions are separate tables
+        :param kind: 'linear' or 'cubic' (not-a-knot cubic spline)
+        """
+
+        values = N.asarray(values, dtype=N.float64)
+        self.xmin = xmin
+        self.xmax = xmax
+        self.npts = values.shape[-1]
+        self.kind = kind
+        self.delta = (xmax-xmin) / (self.npts-1)
+        self.invdelta = 1 / self.delta
+        self.values = values
+
+        # coefficients of polynomial in the fractional position t
+        # within each interval, starting with the constant term
+        if kind == 'linear':
+            coeffs = [values[..., :-1], N.diff(values, axis=-1)]
+        elif kind == 'cubic':
+            x = N.linspace(xmin, xmax, self.npts)
+            c = scipy.interpolate.CubicSpline(x, values, axis=-1).c
+            # c has shape (4, ..., nintervals) in descending powers of x-x_i
+            c = N.moveaxis(c, 1, -1) if c.ndim > 2 else c
+            h = self.delta
+            coeffs = [c[3], c[2]*h, c[1]*h**2, c[0]*h**3]
+        else:
+            raise ValueError('Invalid interpolation kind')
+
+        # shape (..., nintervals, order+1)
+        self.coeffs = N.stack(coeffs, axis=-1)
+
+    def invWidth(self, idx):
+        return self.invdelta
+
+    def locate(self, x):
+        pos = (N.asarray(x, dtype=N.float64) - self.xmin) * self.invdelta
+        pos = N.clip(pos, 0, self.npts-1)
+        idx = N.minimum(pos.astype(N.intp), self.npts-2)
+        return idx, pos-idx
+
+class NonUniformGridTable(_PolyTable):
+    """Linearly interpolate values tabulated on a non-uniform grid.
+
+    The grid is divided into uniform cells narrower than the smallest
+    interval, each mapping to the interval containing its start, so
+    an interval is found with index arithmetic and one comparison.
+    """
+
+    def __init__(self, x, values):
+        """
+        :param x: increasing grid values
+        :param values: array of values with shape (..., len(x)), where the leading dimensions are separate tables
+        """
+
+        self.x = x = N.array(x, dtype=N.float64)
+        values = N.asarray(values, dtype=N.float64)
+        self.values = values
+        self.npts = len(x)
+        self.xmin = x[0]
+        self.xmax = x[-1]
+        self.invwidth = 1 / N.diff(x)
+
+        self.ncells = int(N.ceil((x[-1]-x[0]) * self.invwidth.max())) + 1
+        self.invcell = self.ncells / (x[-1]-x[0])
+        celledges = x[0] + N.arange(self.ncells) / self.invcell
+        self.cellidx = N.clip(
+            N.searchsorted(x, celledges, side='right')-1, 0, self.npts-2)
+
+        self.coeffs = N.stack(
+            [values[..., :-1], N.diff(values, axis=-1)], axis=-1)
+
+    def invWidth(self, idx):
+        return self.invwidth[idx]
+
+    def locate(self, x):
+        x = N.clip(N.asarray(x, dtype=N.float64), self.xmin, self.xmax)
+        cell = N.minimum(
+            ((x-self.xmin)*self.invcell).astype(N.intp), self.ncells-1)
+        idx = self.cellidx[cell]
+        # a cell contains at most one grid point, so at most one step
+        idx = N.minimum(idx + (x >= self.x[idx+1]), self.npts-2)
+        return idx, (x-self.x[idx])*self.invwidth[idx]
+
+def makeGridTable(x, values):
+    """Return a linear interpolating table, using the faster uniform
+    lookup if the grid is uniform."""
+
+    x = N.asarray(x, dtype=N.float64)
+    delta = N.diff(x)
+    if N.allclose(delta, delta[0], rtol=1e-10, atol=0):
+        return UniformGridTable(x[0], x[-1], values)
+    return NonUniformGridTable(x, values)
@@ -264,20 +264,20 @@ def replayChainSB(
             backscale = 1.
 
         ne_prof, T_prof, Z_prof = model.computeProfs(fakefit.pars)
-        for i, band in enumerate(data.bands):
-            clustprof, backprof = band.calcProjProfileCmpts(
-                annuli, ne_prof, T_prof, Z_prof,
-                model.NH_1022pcm2,
-                backscale=backscale)
-
-            # convert to rates / s / arcmin2
-            scale = 1/(annuli.geomarea_arcmin2 * band.areascales * band.exposures)
-            clustprof *= scale
-            backprof *= scale
-
-            totprofs[i].append(clustprof+backprof)
-            clustprofs[i].append(clustprof)
-            backprofs[i].append(backprof)
+        rates = data.calcCountRates(
+            ne_prof, T_prof, Z_prof, model.computeNH(fakefit.pars))
+        clustprof, backprof = data.projectCountRates(
+            rates, backscale=backscale)
+
+        # convert to rates / s / arcmin2
+        scale = 1/(annuli.geomarea_arcmin2 * data.areascales * data.exposures)
+        clustprof = clustprof*scale
+        backprof = backprof*scale
+
+        for i in range(len(data.bands)):
+            totprofs[i].append(clustprof[i]+backprof[i])
+            clustprofs[i].append(clustprof[i])
+            backprofs[i].append(backprof[i])
 
     def getrange(profs):
         median, posrange, negrange = N.percentile(
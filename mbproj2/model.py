@@ -53,6 +53,22 @@ class Model:
         :return: default dict of parameters (names to Param objects).
         """
 
+    def computeNH(self, pars):
+        """Return absorbing column density.
+
+        This is the NH_1022pcm2 parameter, if it is included in the
+        parameters, otherwise the fixed value given to the model.
+        Fitting the column density requires the count rates to be
+        computed on a grid of column densities
+        (CountRate.NHgrid_1022pcm2).
+
+        :type pars: dict[str, Param]
+        :param pars: parameter values
+        """
+        if 'NH_1022pcm2' in pars:
+            return pars['NH_1022pcm2'].val
+        return self.NH_1022pcm2
+
     def computeProfs(self, pars):
         """Compute profiles of physical parameters.
 
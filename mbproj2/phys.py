@@ -70,7 +70,7 @@ def physFromProfs(model, pars):
     v['ne_pcm3'] = ne_prof
     v['T_keV'] = T_prof
     v['Z_solar'] = Z_prof
-    v['NH_1022pcm2'] = N.full(nshells, model.NH_1022pcm2)
+    v['NH_1022pcm2'] = N.full(nshells, model.computeNH(pars))
     v['P_ergpcm3'] = T_prof * ne_prof * P_keV_to_erg
     v['g_cmps2'] = g_prof
     v['potential_ergpg'] = pot_prof
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Operators projecting emission in spherical shells onto annuli.
+
+The projection matrix (see utils.projectionVolumeMatrix) is upper
+triangular, as a shell only projects onto annuli inside it.
+DenseProjection stores the full matrix, which is fastest for small
+numbers of annuli. TriangularProjection stores only the triangle, or
+optionally only the shells within a number of shells outside each
+annulus, and applies it with the BLAS triangular kernels. This halves
+the memory and operations for large numbers of annuli.
+
+If the model shells are different from the annuli (e.g. a coarse
+grid of shells for finely binned data), RectangularProjection
+projects from the shells onto the annuli.
+
+Bands combine the projection with their PSF, area scaling and
+exposure into a single operator (see Band.responseOperator).
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import copy
+
+import numpy as N
+
+try:
+    from scipy.linalg.blas import dtpmv, dtbmv, stpmv, stbmv
+except ImportError:
+    # older scipy
+    dtpmv = dtbmv = stpmv = stbmv = None
+
+from . import utils
+
+class MatrixOperator:
+    """Operator applying a dense matrix."""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def dot(self, emiss):
+        """Project emission in each shell (shape (nshells,) or
+        (nshells, m)) onto each annulus."""
+        return self.matrix.dot(emiss)
+
+    def dotT(self, weights):
+        """Multiply by the transpose of the matrix (for derivatives)."""
+        return self.matrix.T.dot(weights)
+
+    def toarray(self):
+        """Return matrix as a dense array."""
+        return self.matrix
+
+    def rowScaled(self, scale):
+        """Return operator with the output for each annulus
+        multiplied by scale."""
+        return MatrixOperator(self.matrix * scale[:, N.newaxis])
+
+    def astype(self, dtype):
+        """Return operator using values of the type given (e.g. N.float32)."""
+        return MatrixOperator(self.matrix.astype(dtype))
+
+class DenseProjection(MatrixOperator):
+    """Projection using the full matrix."""
+
+    def __init__(self, radii_cm):
+        """
+        :param radii_cm: edges of shells and annuli in cm
+        """
+        MatrixOperator.__init__(self, utils.projectionVolumeMatrix(radii_cm))
+
+class RectangularProjection(MatrixOperator):
+    """Projection from shells with different edges to the annuli."""
+
+    def __init__(self, radii_cm, shellradii_cm):
+        """
+        :param radii_cm: edges of annuli in cm
+        :param shellradii_cm: edges of shells in cm
+        """
+        MatrixOperator.__init__(
+            self, utils.projectionVolumeMatrix(radii_cm, shellradii_cm))
+
+class TriangularProjection:
+    """Projection storing only the upper triangle of the matrix.
+
+    If bandwidth is set, only shells up to bandwidth shells outside
+    each annulus are included. The emission from shells further out
+    is then ignored, which is reasonable if the emission falls off
+    steeply with radius.
+    """
+
+    def __init__(self, radii_cm, bandwidth=None):
+        """
+        :param radii_cm: edges of shells and annuli in cm
+        :param bandwidth: if set, number of shells outside each annulus to include
+        """
+
+        n = self.n = len(radii_cm)-1
+        self.bandwidth = None if bandwidth is None else min(int(bandwidth), n-1)
+        self._dense = None
+
+        if self.bandwidth is None:
+            # packed upper triangle, stored by columns (shells)
+            j_s, i_s = N.tril_indices(n)
+            self.packed = utils.projectionVolumeElements(radii_cm, i_s, j_s)
+        else:
+            # BLAS band storage: row k-d holds diagonal d, so that
+            # banded[k+i-j, j] is element (i, j)
+            k = self.bandwidth
+            self.banded = N.zeros((k+1, n))
+            for d in range(k+1):
+                j_s = N.arange(d, n)
+                self.banded[k-d, d:] = utils.projectionVolumeElements(
+                    radii_cm, j_s-d, j_s)
+
+    def _apply(self, x, trans):
+        vals = self.packed if self.bandwidth is None else self.banded
+        x = N.asarray(x, dtype=vals.dtype)
+        if x.ndim > 1:
+            return N.column_stack([
+                self._apply(x[:, i], trans) for i in range(x.shape[1])])
+
+        if dtpmv is None:
+            m = self.toarray()
+            return (m.T if trans else m).dot(x)
+
+        single = vals.dtype == N.float32
+        if self.bandwidth is None:
+            return (stpmv if single else dtpmv)(self.n, vals, x, trans=trans)
+        return (stbmv if single else dtbmv)(
+            self.bandwidth, vals, x, trans=trans)
+
+    def dot(self, emiss):
+        """Project emission in each shell (shape (nshells,) or
+        (nshells, m)) onto each annulus."""
+        return self._apply(emiss, 0)
+
+    def dotT(self, weights):
+        """Multiply by the transpose of the matrix (for derivatives)."""
+        return self._apply(weights, 1)
+
+    def rowScaled(self, scale):
+        """Return operator with the output for each annulus
+        multiplied by scale (which is still triangular)."""
+        out = copy.copy(self)
+        out._dense = None
+        n = self.n
+        if self.bandwidth is None:
+            j_s, i_s = N.tril_indices(n)
+            out.packed = self.packed * scale[i_s]
+        else:
+            k = self.bandwidth
+            out.banded = self.banded.copy()
+            for d in range(k+1):
+                out.banded[k-d, d:] *= scale[:n-d]
+        return out
+
+    def astype(self, dtype):
+        """Return operator using values of the type given (N.float32
+        or N.float64)."""
+        out = copy.copy(self)
+        out._dense = None
+        if self.bandwidth is None:
+            out.packed = self.packed.astype(dtype)
+        else:
+            out.banded = self.banded.astype(dtype)
+        return out
+
+    def toarray(self):
+        """Return projection matrix as a dense array (which is kept,
+        as it is needed for per-annulus responses and PSFs)."""
+        if self._dense is None:
+            n = self.n
+            vals = self.packed if self.bandwidth is None else self.banded
+            m = N.zeros((n, n), dtype=vals.dtype)
+            if self.bandwidth is None:
+                j_s, i_s = N.tril_indices(n)
+                m[i_s, j_s] = self.packed
+            else:
+                k = self.bandwidth
+                for d in range(k+1):
+                    j_s = N.arange(d, n)
+                    m[j_s-d, j_s] = self.banded[k-d, d:]
+            self._dense = m
+        return self._dense
+
+projections = {
+    'dense': DenseProjection,
+    'triangular': TriangularProjection,
+    }
+
+def makeProjection(radii_cm, kind='dense', bandwidth=None, shellradii_cm=None):
+    """Make projection operator.
+
+    :param radii_cm: edges of shells and annuli in cm
+    :param kind: 'dense' or 'triangular'
+    :param bandwidth: number of shells outside each annulus to include (triangular only)
+    :param shellradii_cm: if set, edges of the shells in cm, if different from the annuli (the kind is then ignored)
+    """
+    if shellradii_cm is not None:
+        return RectangularProjection(radii_cm, shellradii_cm)
+    try:
+        cls = projections[kind]
+    except KeyError:
+        raise RuntimeError('Unknown projection %s' % kind)
+    if bandwidth is not None:
+        return cls(radii_cm, bandwidth=bandwidth)
+    return cls(radii_cm)
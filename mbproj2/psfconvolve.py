@@ -25,16 +25,11 @@ profiles when using a PSF.
 
 from __future__ import division, print_function, absolute_import
 
-import warnings
-import hashlib
-
 import numpy as N
-import h5py
 import scipy.signal
 import scipy.sparse
-import six
 
-from . import utils
+from . import tablecache
 from .utils import uprint
 
 def makePSFImage(psf_edges, psf_val, pix_size):
@@ -93,7 +88,7 @@ def linearComputePSFMatrix(
     # output response matrix
     matout = N.zeros( (len(shell_edges)-1, len(shell_edges)-1) )
 
-    for i, (e1, e2) in enumerate(six.zip(shell_edges[:-1], shell_edges[1:])):
+    for i, (e1, e2) in enumerate(zip(shell_edges[:-1], shell_edges[1:])):
         uprint(' shell', i)
 
         # split up shell and compute average midpoint radius
@@ -102,7 +97,7 @@ def linearComputePSFMatrix(
         # scale contributions by area on sky
         subscales = (1./(e2**2-e1**2))*(subedges[1:]**2-subedges[:-1]**2)
 
-        for subrad, subscale in six.zip(subrads, subscales):
+        for subrad, subscale in zip(subrads, subscales):
             psfrad_sqd = (psfx_f+subrad)**2 + psfy_f_sqd
 
             hist, edges = N.histogram(
@@ -128,7 +123,7 @@ def convComputePSFMatrix(psf_edges, psf_val, shell_edges, oversample=4):
     # output response matrix
     matout = N.zeros( (len(shell_edges)-1, len(shell_edges)-1) )
 
-    for i, (e1, e2) in enumerate(six.zip(shell_edges[:-1], shell_edges[1:])):
+    for i, (e1, e2) in enumerate(zip(shell_edges[:-1], shell_edges[1:])):
         uprint(' shell', i)
         # make an image of shell and convolve with psf
         imgsize = int(N.ceil((e2+psf_edges[-1])/pix_size))*2+1
@@ -152,31 +147,30 @@ def convComputePSFMatrix(psf_edges, psf_val, shell_edges, oversample=4):
     return matout
 
 def convImagePSFMatrix(psfimg, pixsize_arcmin, shell_edges, cache=True,
-                       cachefile='psf_cache.hdf5'):
-    """Compute a convolution PSF matrix using the image given (uncached version).
+                       cachefile=None):
+    """Compute a convolution PSF matrix using the image given.
 
-    If cache is true, then
+    If cache is true, then the result is stored in the table cache
+    (see tablecache module). cachefile is obsolete and ignored.
     """
 
     if not cache:
         return _innerConvImagePSFMatrix(psfimg, pixsize_arcmin, shell_edges)
 
     # create unique key based on parameters
-    h = hashlib.md5()
-    h.update(N.ascontiguousarray(psfimg))
-    h.update(N.ascontiguousarray([pixsize_arcmin]))
-    h.update(N.ascontiguousarray(shell_edges))
-    key = h.hexdigest()
-
-    with utils.WithLock(cachefile+'.lockdir') as lock:
-        cachef = h5py.File(cachefile)
-        if key in cachef:
-            psfmat = N.array(cachef[key])
-        else:
-            psfmat = _innerConvImagePSFMatrix(psfimg, pixsize_arcmin, shell_edges)
-            cachef[key] = psfmat
-        cachef.close()
-
+    key = tablecache.hashKey((
+        'convimagepsf', N.asarray(psfimg), float(pixsize_arcmin),
+        N.asarray(shell_edges)))
+
+    store = tablecache.getDefaultCache()
+    cached = store.get(key)
+    if cached is not None:
+        return cached['psf']
+
+    meta = {'kind': 'psf', 'method': 'convimage', 'nshells': len(shell_edges)-1}
+    store.checkCanCompute([meta])
+    psfmat = _innerConvImagePSFMatrix(psfimg, pixsize_arcmin, shell_edges)
+    store.put(key, {'psf': psfmat}, meta=meta)
     return psfmat
 
 def _innerConvImagePSFMatrix(psfimg, pixsize_arcmin, shell_edges):
@@ -198,7 +192,7 @@ def _innerConvImagePSFMatrix(psfimg, pixsize_arcmin, shell_edges):
         if i % 20 == 0:
             uprint(' shell', i)
 
-        annimg = ((radii >= e1) & (radii < e2)).astype(N.float)
+        annimg = ((radii >= e1) & (radii < e2)).astype(N.float64)
         annimg *= 1./annimg.sum()
 
         conv = scipy.signal.fftconvolve(annimg, psfimgnorm, mode='same')
@@ -213,19 +207,27 @@ def _innerConvImagePSFMatrix(psfimg, pixsize_arcmin, shell_edges):
 
     return matout
 
-def cachedPSFMatrix(psf_edge, psf_val, shell_edges, cachefile='psf_cache.hdf5'):
-    """Return PSF matrix, getting cached version if possible."""
-
-    h = hashlib.md5()
-    h.update(N.ascontiguousarray(psf_edge))
-    h.update(N.ascontiguousarray(psf_val))
-    h.update(N.ascontiguousarray(shell_edges))
-    key = h.hexdigest()
-
-    with utils.WithLock(cachefile+'.lockdir') as lock:
-        with h5py.File(cachefile) as cache:
-            if key not in cache:
-                psf = linearComputePSFMatrix(psf_edge, psf_val, shell_edges)
-                cache[key] = psf
-            m = N.array(cache[key])
-    return m
+def cachedPSFMatrixKey(psf_edge, psf_val, shell_edges):
+    """Key in table cache used by cachedPSFMatrix."""
+    return tablecache.hashKey((
+        'linearpsf', N.asarray(psf_edge), N.asarray(psf_val),
+        N.asarray(shell_edges)))
+
+def cachedPSFMatrix(psf_edge, psf_val, shell_edges, cachefile=None):
+    """Return PSF matrix, getting cached version if possible.
+
+    The matrix is stored in the table cache (see tablecache
+    module). cachefile is obsolete and ignored.
+    """
+
+    key = cachedPSFMatrixKey(psf_edge, psf_val, shell_edges)
+    store = tablecache.getDefaultCache()
+    cached = store.get(key)
+    if cached is not None:
+        return cached['psf']
+
+    meta = {'kind': 'psf', 'method': 'linear', 'nshells': len(shell_edges)-1}
+    store.checkCanCompute([meta])
+    psf = linearComputePSFMatrix(psf_edge, psf_val, shell_edges)
+    store.put(key, {'psf': psf}, meta=meta)
+    return psf
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Backends used by CountRate to compute tables of count rates and
+fluxes on a grid of temperatures.
+
+The default backend runs xspec. The emulator backend runs a stand-in
+program speaking the same protocol (see xspecemulator), so that the
+code can be run and tested without xspec installed. The fold backend
+folds spectra through the responses directly (see responsefold). The backend can
+be chosen by setting the environment variable MBPROJ2_BACKEND to the
+name of a backend, or by setting CountRate.backend.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import sys
+import multiprocessing
+import multiprocessing.pool
+from math import pi
+
+import numpy as N
+
+from .xspechelper import XSpecHelper, XSpecPool
+from .physconstants import Mpc_cm, ne_nH, keV_erg
+from . import responsefold
+
+class RateBackend:
+    """Base class for computing count rate and flux tables."""
+
+    # name of backend, included in the key for cached tables
+    name = None
+
+    # whether channelRateTables is supported
+    channelTables = False
+
+    def countRateTables(self, keys, T_keV, cosmo, workers=None):
+        """Compute count rate tables.
+
+        :param keys: list of (minenergy_keV, maxenergy_keV, z, NH_1022, rmf, arf)
+        :param T_keV: temperature grid, or list of grids for each key
+        :param Cosmology cosmo: cosmology (used at the redshift in each key)
+        :param workers: maximum number of simultaneous processes
+        :returns: list of arrays of Z=0 and Z=1 rates for each key, shape (2, len(T_keV))
+        """
+        raise NotImplementedError
+
+    def channelRateTables(self, chankeys, T_keV, cosmo, workers=None):
+        """Compute count rate tables for each channel of the response.
+
+        :param chankeys: list of (z, NH_1022, rmf, arf)
+        :param T_keV: temperature grid
+        :param Cosmology cosmo: cosmology (used at the redshift in each key)
+        :param workers: maximum number of simultaneous processes
+        :returns: list of (channel minimum energies, channel maximum energies, rates) for each key, where the Z=0 and Z=1 rates have shape (2, len(T_keV), nchannels)
+        """
+        raise NotImplementedError('Backend does not compute channel tables')
+
+    def fluxTables(self, T_keV, cosmo, ebands):
+        """Compute tables of fluxes in several energy bands.
+
+        :param T_keV: temperature grid
+        :param Cosmology cosmo: cosmology
+        :param ebands: list of (emin_keV, emax_keV)
+        :returns: array of Z=0 and Z=1 fluxes, shape (len(ebands), 2, len(T_keV))
+        """
+        raise NotImplementedError
+
+class XSpecBackend(RateBackend):
+    """Compute tables by running xspec processes."""
+
+    name = 'xspec'
+
+    def __init__(self, command=None):
+        """
+        :param command: command line for xspec (default ['xspec'])
+        """
+        self.command = command
+
+    def countRateTables(self, keys, T_keV, cosmo, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if isinstance(T_keV, list):
+            Tgrids = T_keV
+        else:
+            Tgrids = [T_keV]*len(keys)
+
+        def compute(xspec, arg):
+            key, Tgrid = arg
+            minenergy_keV, maxenergy_keV, z, NH_1022, rmf, arf = key
+            xspec.changeResponse(rmf, arf, minenergy_keV, maxenergy_keV)
+            return xspec.getCountsPerSecGrid(
+                NH_1022, Tgrid, (0., 1.), cosmo.withRedshift(z), 1.)
+
+        pool = XSpecPool(min(workers, len(keys)), command=self.command)
+        try:
+            return pool.map(compute, list(zip(keys, Tgrids)))
+        finally:
+            pool.finish()
+
+    def fluxTables(self, T_keV, cosmo, ebands):
+        xspec = XSpecHelper(command=self.command)
+        try:
+            xspec.dummyResponse()
+            return xspec.getFluxGrids(T_keV, (0., 1.), cosmo, 1., ebands)
+        finally:
+            xspec.finish()
+
+class EmulatorBackend(XSpecBackend):
+    """Compute tables using the analytic xspec emulator.
+
+    The results are only approximate, but this does not need xspec.
+    """
+
+    name = 'emulator'
+
+    def __init__(self):
+        XSpecBackend.__init__(self, command=[
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), 'xspecemulator.py')])
+
+class FoldBackend(RateBackend):
+    """Compute tables by folding spectra through the responses with
+    numpy, without a subprocess.
+
+    By default the spectra come from a SpectrumGrid file given by
+    the environment variable MBPROJ2_SPECTRUM_GRID, otherwise the
+    approximate emulator spectra are used.
+    """
+
+    channelTables = True
+
+    # number of energy bins used for flux calculations
+    fluxbins = 1000
+
+    def __init__(self, spectra=None):
+        """
+        :param spectra: spectrum object (see responsefold)
+        """
+        if spectra is None:
+            gridfile = os.environ.get('MBPROJ2_SPECTRUM_GRID')
+            if gridfile:
+                spectra = responsefold.loadSpectrumGrid(gridfile)
+            else:
+                spectra = responsefold.EmulatorSpectra()
+        self.spectra = spectra
+        self.name = 'fold_%s' % spectra.name
+        self.responses = {}
+
+    def getResponse(self, rmf, arf):
+        """Get (cached) Response object."""
+        if (rmf, arf) not in self.responses:
+            self.responses[(rmf, arf)] = responsefold.Response(rmf, arf)
+        return self.responses[(rmf, arf)]
+
+    def _distFactor(self, cosmo):
+        """Convert emissivity per ne nH to flux at ne=1 cm^-3."""
+        return 1 / (4*pi*(cosmo.D_A*Mpc_cm*(1+cosmo.z))**2 * ne_nH)
+
+    def countRateTables(self, keys, T_keV, cosmo, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if isinstance(T_keV, list):
+            Tgrids = T_keV
+        else:
+            Tgrids = [T_keV]*len(keys)
+
+        def compute(arg):
+            key, Tgrid = arg
+            minenergy_keV, maxenergy_keV, z, NH_1022, rmf, arf = key
+            resp = self.getResponse(rmf, arf)
+            zcosmo = cosmo.withRedshift(z)
+            spec = self.spectra.observed(
+                resp.elo_keV, resp.ehi_keV, N.asarray(Tgrid), z)
+            area = resp.bandArea(minenergy_keV, maxenergy_keV) * (
+                self.spectra.transmission(
+                    0.5*(resp.elo_keV+resp.ehi_keV), NH_1022))
+            return spec.dot(area) * self._distFactor(zcosmo)
+
+        # load the responses before folding in parallel
+        for key in keys:
+            self.getResponse(key[4], key[5])
+
+        # numpy releases the GIL, so threads can run in parallel
+        pool = multiprocessing.pool.ThreadPool(max(min(workers, len(keys)), 1))
+        try:
+            return pool.map(compute, list(zip(keys, Tgrids)))
+        finally:
+            pool.close()
+
+    def channelRateTables(self, chankeys, T_keV, cosmo, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        def compute(chankey):
+            z, NH_1022, rmf, arf = chankey
+            resp = self.getResponse(rmf, arf)
+            spec = self.spectra.observed(
+                resp.elo_keV, resp.ehi_keV, N.asarray(T_keV), z)
+            spec *= self.spectra.transmission(
+                0.5*(resp.elo_keV+resp.ehi_keV), NH_1022)
+            rates = resp.fold(spec) * self._distFactor(cosmo.withRedshift(z))
+            return resp.chan_emin_keV, resp.chan_emax_keV, rates
+
+        for chankey in chankeys:
+            self.getResponse(chankey[2], chankey[3])
+
+        pool = multiprocessing.pool.ThreadPool(
+            max(min(workers, len(chankeys)), 1))
+        try:
+            return pool.map(compute, chankeys)
+        finally:
+            pool.close()
+
+    def fluxTables(self, T_keV, cosmo, ebands):
+        out = []
+        for emin_keV, emax_keV in ebands:
+            edges = N.logspace(
+                N.log10(emin_keV), N.log10(emax_keV), self.fluxbins+1)
+            elo, ehi = edges[:-1], edges[1:]
+            spec = self.spectra.observed(elo, ehi, N.asarray(T_keV), cosmo.z)
+            out.append(
+                spec.dot(0.5*(elo+ehi)) * keV_erg * self._distFactor(cosmo))
+        return N.array(out)
+
+backends = {
+    'xspec': XSpecBackend,
+    'emulator': EmulatorBackend,
+    'fold': FoldBackend,
+    }
+
+def getBackend(name=None):
+    """Return backend given name.
+
+    If name is None, use the MBPROJ2_BACKEND environment variable,
+    defaulting to xspec.
+    """
+    if name is None:
+        name = os.environ.get('MBPROJ2_BACKEND', 'xspec')
+    try:
+        return backends[name]()
+    except KeyError:
+        raise RuntimeError('Unknown count rate backend %s' % name)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Fold model spectra through responses without running xspec.
+
+The RMF and ARF are read from their FITS files (requires astropy)
+into a sparse matrix. Spectra for many temperatures are then folded
+with a single matrix product.
+
+The emission spectra come from a spectrum object, which has the
+attribute name and the methods observed (photon emissivities in
+observed energy bins) and transmission (absorption). SpectrumGrid
+interpolates spectra tabulated in a file, for example from APEC,
+while EmulatorSpectra uses the approximate model in xspecemulator.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+import scipy.sparse
+
+try:
+    from astropy.io import fits
+except ImportError:
+    fits = None
+
+from . import xspecemulator
+from . import tablecache
+
+def _readMatrix(hdu, nchan):
+    """Read OGIP response matrix extension into a sparse matrix with
+    shape (nenergy, nchan)."""
+
+    data = hdu.data
+    cols = [c.upper() for c in data.columns.names]
+    # channel numbering starts at TLMIN of F_CHAN (default 1)
+    offset = hdu.header.get('TLMIN%i' % (cols.index('F_CHAN')+1), 1)
+
+    rows, chans, vals = [], [], []
+    for i in range(len(data)):
+        ngrp = int(data['N_GRP'][i])
+        fchan = N.atleast_1d(data['F_CHAN'][i])[:ngrp]
+        nchang = N.atleast_1d(data['N_CHAN'][i])[:ngrp]
+        if ngrp == 0:
+            continue
+        c = N.concatenate([
+            N.arange(f, f+n) for f, n in zip(fchan, nchang)]) - offset
+        rows.append(N.full(len(c), i))
+        chans.append(c)
+        vals.append(N.atleast_1d(data['MATRIX'][i])[:len(c)])
+
+    return scipy.sparse.csr_matrix(
+        (N.concatenate(vals), (N.concatenate(rows), N.concatenate(chans))),
+        shape=(len(data), nchan))
+
+class Response:
+    """Response read from RMF and ARF files."""
+
+    def __init__(self, rmf, arf):
+        """
+        :param rmf: RMF filename
+        :param arf: ARF filename (or 'none', if included in the RMF)
+        """
+
+        if fits is None:
+            raise RuntimeError('astropy is required to read responses')
+
+        with fits.open(rmf) as f:
+            ebounds = f['EBOUNDS'].data
+            self.chan_emin_keV = N.array(ebounds['E_MIN'], dtype=N.float64)
+            self.chan_emax_keV = N.array(ebounds['E_MAX'], dtype=N.float64)
+            nchan = len(ebounds)
+
+            hdu = f['MATRIX'] if 'MATRIX' in f else f['SPECRESP MATRIX']
+            self.elo_keV = N.array(hdu.data['ENERG_LO'], dtype=N.float64)
+            self.ehi_keV = N.array(hdu.data['ENERG_HI'], dtype=N.float64)
+            matrix = _readMatrix(hdu, nchan)
+
+        if arf is not None and arf.lower() != 'none':
+            with fits.open(arf) as f:
+                area = N.array(f['SPECRESP'].data['SPECRESP'], dtype=N.float64)
+            if len(area) != len(self.elo_keV):
+                raise RuntimeError(
+                    'ARF %s does not match RMF %s' % (arf, rmf))
+            matrix = scipy.sparse.diags(area).dot(matrix).tocsr()
+
+        # effective area (cm^2) for each energy and channel
+        self.matrix = matrix
+
+    def fold(self, photons):
+        """Fold photon fluxes through the response.
+
+        :param photons: photons cm^-2 s^-1 in each energy bin, shape (..., nenergy)
+        :returns: counts per second in each channel, shape (..., nchan)
+        """
+        photons = N.asarray(photons)
+        flat = photons.reshape(-1, photons.shape[-1])
+        out = self.matrix.T.dot(flat.T).T
+        return out.reshape(photons.shape[:-1] + (out.shape[-1],))
+
+    def bandChannels(self, emin_keV, emax_keV):
+        """Channels with nominal energies inside the band."""
+        cent = 0.5*(self.chan_emin_keV+self.chan_emax_keV)
+        return (cent >= emin_keV) & (cent <= emax_keV)
+
+    def bandArea(self, emin_keV, emax_keV):
+        """Effective area (cm^2) at each energy for detecting counts in
+        the band."""
+        sel = self.bandChannels(emin_keV, emax_keV).astype(N.float64)
+        return self.matrix.dot(sel)
+
+class SpectrumGrid:
+    """Spectra tabulated in the rest frame on a grid of temperatures,
+    for metallicities of 0 and 1 solar."""
+
+    def __init__(self, ebounds_keV, T_keV, spectra,
+                 sigma_energy_keV=None, sigma_cm2=None):
+        """
+        :param ebounds_keV: rest energy bin edges (nbins+1)
+        :param T_keV: increasing temperatures of spectra
+        :param spectra: photons cm^3 s^-1 in each bin (per ne nH), shape (2, len(T_keV), nbins) for Z=0 and Z=1
+        :param sigma_energy_keV: energies of photoelectric cross sections
+        :param sigma_cm2: cross sections per hydrogen atom (if not given, use approximate ones)
+        """
+
+        self.ebounds_keV = N.array(ebounds_keV, dtype=N.float64)
+        self.logT = N.log(N.array(T_keV, dtype=N.float64))
+        spectra = N.array(spectra, dtype=N.float64)
+        # cumulative emission in energy, so that spectra can be rebinned
+        self.cumul = N.concatenate((
+            N.zeros(spectra.shape[:-1]+(1,)), N.cumsum(spectra, axis=-1)),
+            axis=-1)
+
+        self.sigma_energy_keV = sigma_energy_keV
+        self.sigma_cm2 = sigma_cm2
+
+        items = ['spectrumgrid', self.ebounds_keV, self.logT, spectra]
+        if sigma_cm2 is not None:
+            items += [N.asarray(sigma_energy_keV), N.asarray(sigma_cm2)]
+        self.name = 'grid_' + tablecache.hashKey(items)[:16]
+
+    def observed(self, elo_keV, ehi_keV, T_keV, z):
+        """Photons cm^3 s^-1 in each observed energy bin (per ne nH),
+        interpolating linearly in log temperature.
+
+        :returns: array with shape (2, len(T_keV), len(elo_keV))
+        """
+
+        # interpolate in temperature
+        logT = N.clip(N.log(T_keV), self.logT[0], self.logT[-1])
+        ti = N.clip(N.searchsorted(self.logT, logT)-1, 0, len(self.logT)-2)
+        tw = ((logT-self.logT[ti]) / (self.logT[ti+1]-self.logT[ti]))[:, None]
+        cumul = self.cumul[:, ti, :]*(1-tw) + self.cumul[:, ti+1, :]*tw
+
+        # interpolate cumulative emission at the rest frame energies
+        # of the edges of the bins
+        def cumulAt(e_keV):
+            e = N.clip(e_keV*(1+z), self.ebounds_keV[0], self.ebounds_keV[-1])
+            ei = N.clip(
+                N.searchsorted(self.ebounds_keV, e)-1, 0,
+                len(self.ebounds_keV)-2)
+            ew = (e-self.ebounds_keV[ei]) / (
+                self.ebounds_keV[ei+1]-self.ebounds_keV[ei])
+            return cumul[..., ei]*(1-ew) + cumul[..., ei+1]*ew
+
+        # time dilation
+        return (cumulAt(ehi_keV) - cumulAt(elo_keV)) / (1+z)
+
+    def transmission(self, E_keV, NH_1022):
+        """Absorption transmission at energies given."""
+        if self.sigma_cm2 is None:
+            return xspecemulator.phabsTransmission(E_keV, NH_1022)
+        sigma = N.exp(N.interp(
+            N.log(E_keV), N.log(self.sigma_energy_keV), N.log(self.sigma_cm2)))
+        return N.exp(-NH_1022*1e22*sigma)
+
+def loadSpectrumGrid(filename):
+    """Load SpectrumGrid from a numpy .npz file.
+
+    The file contains the arrays ebounds_keV, T_keV and spectra, and
+    optionally sigma_energy_keV and sigma_cm2 (see SpectrumGrid).
+    """
+    with N.load(filename) as f:
+        return SpectrumGrid(
+            f['ebounds_keV'], f['T_keV'], f['spectra'],
+            sigma_energy_keV=f['sigma_energy_keV'] if 'sigma_cm2' in f else None,
+            sigma_cm2=f['sigma_cm2'] if 'sigma_cm2' in f else None)
+
+class EmulatorSpectra:
+    """Approximate spectra from the xspec emulator (not for science)."""
+
+    name = 'emulator'
+
+    # number of points used to integrate over each bin
+    subsamples = 5
+
+    def observed(self, elo_keV, ehi_keV, T_keV, z):
+        frac = N.linspace(0, 1, self.subsamples)
+        e = elo_keV[:, None] + (ehi_keV-elo_keV)[:, None]*frac[None, :]
+        out = N.zeros((2, len(T_keV), len(elo_keV)))
+        for zi, Z in enumerate((0., 1.)):
+            for ti, T in enumerate(T_keV):
+                spec = xspecemulator.apecSpectrum(e, T, Z, z)
+                out[zi, ti, :] = N.sum(
+                    0.5*(spec[:, 1:]+spec[:, :-1])*N.diff(e, axis=1), axis=1)
+        return out
+
+    def transmission(self, E_keV, NH_1022):
+        return xspecemulator.phabsTransmission(E_keV, NH_1022)
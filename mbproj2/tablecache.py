@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""On-disk cache of computed tables (count rates, PSF matrices).
+
+Each entry is stored in its own file, named by a hash of its key.
+Files are written to a temporary name and renamed into place, so
+readers never see partial files and no locking is needed. Keys which
+refer to response files use a hash of the file contents, so entries
+remain valid if files are moved or renamed.
+
+The cache directory is given by the environment variable
+MBPROJ2_CACHE_DIR, defaulting to ~/.cache/mbproj2.
+
+Tables can also be exported to a bundle, a single .npz file with a
+manifest describing each table, for use on machines which cannot
+compute tables (e.g. without xspec). Bundles listed in the
+environment variable MBPROJ2_TABLE_BUNDLES (separated by os.pathsep)
+are mounted read-only. The cache is then offline: missing tables
+raise MissingTablesError, listing what is missing, instead of being
+computed.
+
+Tables in use are also kept in a process-wide MemoryCache, shared by
+all CountRate objects, which evicts the least recently used tables
+when its size exceeds MBPROJ2_MEMORY_CACHE_MB (default 512).
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import hashlib
+import uuid
+import json
+import struct
+import time
+import threading
+import zipfile
+from collections import OrderedDict
+
+import numpy as N
+
+def deleteFile(filename):
+    """Delete file, ignoring errors."""
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+# hashes of file contents, keyed by filename, size and modification time
+_filedigests = {}
+
+def fileDigest(filename):
+    """Return hash of the contents of the file.
+
+    If the file does not exist, the filename itself is hashed.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return hashlib.sha1(('missing:%s' % filename).encode('utf-8')).hexdigest()
+
+    fkey = (os.path.abspath(filename), st.st_size, st.st_mtime)
+    if fkey not in _filedigests:
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1<<20), b''):
+                h.update(block)
+        _filedigests[fkey] = h.hexdigest()
+    return _filedigests[fkey]
+
+def hashKey(items):
+    """Make a hash from a sequence of strings, numbers and numpy arrays."""
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, N.ndarray):
+            h.update(N.ascontiguousarray(item).tobytes())
+            h.update(repr((item.dtype.str, item.shape)).encode('utf-8'))
+        else:
+            h.update(repr(item).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+class MissingTablesError(RuntimeError):
+    """Tables are not available and cannot be computed."""
+
+    def __init__(self, descriptions):
+        self.descriptions = descriptions
+        RuntimeError.__init__(
+            self,
+            'Tables missing from table cache and bundles (offline, so not '
+            'computing them):\n' + '\n'.join('  '+d for d in descriptions))
+
+    def __reduce__(self):
+        # so that it can be passed between processes
+        return (MissingTablesError, (self.descriptions,))
+
+def describeTable(meta):
+    """Short description of table from its metadata dict."""
+    if meta is None:
+        return 'unknown table'
+    items = ['%s=%s' % (k, meta[k]) for k in sorted(meta) if k != 'kind']
+    return '%s: %s' % (meta.get('kind', 'table'), ' '.join(items))
+
+# version of bundle format
+bundleversion = 1
+
+class TableBundle:
+    """Read-only bundle of tables in a single .npz file.
+
+    Members are named key.arrayname. Tables which are stored
+    uncompressed are memory-mapped when read.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.members = {}
+        manifest = None
+        with zipfile.ZipFile(filename) as zf:
+            for info in zf.infolist():
+                name = info.filename
+                if name[-4:] == '.npy':
+                    name = name[:-4]
+                if name == 'manifest':
+                    with zf.open(info) as f:
+                        manifest = json.loads(
+                            str(N.lib.format.read_array(f)[()]))
+                elif '.' in name:
+                    key, arrname = name.split('.', 1)
+                    self.members.setdefault(key, {})[arrname] = info
+
+        if manifest is None:
+            raise RuntimeError('Not an mbproj2 table bundle: %s' % filename)
+        if manifest['version'] > bundleversion:
+            raise RuntimeError(
+                'Table bundle %s has unsupported version %i' % (
+                    filename, manifest['version']))
+        self.manifest = manifest
+
+    def contains(self, key):
+        return key in self.members
+
+    def _readMember(self, info):
+        """Read array, memory-mapping it if possible."""
+        with open(self.filename, 'rb') as f:
+            if info.compress_type == zipfile.ZIP_STORED:
+                # skip the local file header to the npy data
+                f.seek(info.header_offset)
+                header = f.read(30)
+                fnlen, extralen = struct.unpack('<HH', header[26:30])
+                f.seek(info.header_offset + 30 + fnlen + extralen)
+                version = N.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran, dtype = N.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran, dtype = N.lib.format.read_array_header_2_0(f)
+                if not dtype.hasobject and len(shape) > 0:
+                    return N.memmap(
+                        self.filename, dtype=dtype, mode='r', offset=f.tell(),
+                        shape=shape, order='F' if fortran else 'C')
+
+        with zipfile.ZipFile(self.filename) as zf:
+            with zf.open(info) as f:
+                return N.lib.format.read_array(f)
+
+    def get(self, key):
+        """Return dict of arrays for key, or None if not in bundle."""
+        if key not in self.members:
+            return None
+        return {
+            name: self._readMember(info)
+            for name, info in self.members[key].items()}
+
+class TableCache:
+    """Directory of cached tables, one file per key."""
+
+    def __init__(self, directory=None, maxsize_bytes=2*1024**3):
+        """
+        :param directory: cache directory (default from MBPROJ2_CACHE_DIR or ~/.cache/mbproj2)
+        :param maxsize_bytes: remove least recently used entries if the total size exceeds this
+        """
+        if directory is None:
+            directory = os.environ.get(
+                'MBPROJ2_CACHE_DIR',
+                os.path.join(os.path.expanduser('~'), '.cache', 'mbproj2'))
+        self.directory = directory
+        self.maxsize_bytes = maxsize_bytes
+
+        # mounted TableBundle objects
+        self.bundles = []
+        # if set, missing tables should not be computed
+        self.offline = False
+
+    def mountBundle(self, filename, offline=True):
+        """Make tables in bundle file available (read only).
+
+        :param offline: do not compute missing tables
+        """
+        self.bundles.append(TableBundle(filename))
+        self.offline = self.offline or offline
+
+    def checkCanCompute(self, metas):
+        """Check whether tables can be computed, raising
+        MissingTablesError listing the tables if offline.
+
+        :param metas: list of metadata dicts of tables to compute
+        """
+        if self.offline and metas:
+            raise MissingTablesError([describeTable(m) for m in metas])
+
+    def filename(self, key):
+        """Filename for hashed key."""
+        return os.path.join(self.directory, '%s.npz' % key)
+
+    def contains(self, key):
+        """Is there an entry for hashed key?"""
+        return (
+            any(b.contains(key) for b in self.bundles) or
+            os.path.exists(self.filename(key)))
+
+    def get(self, key):
+        """Return dict of arrays for hashed key, or None if not cached."""
+        for bundle in self.bundles:
+            out = bundle.get(key)
+            if out is not None:
+                return out
+
+        fname = self.filename(key)
+        try:
+            with N.load(fname) as f:
+                out = {name: f[name] for name in f.files}
+        except (IOError, OSError, ValueError):
+            return None
+
+        # update modification time, used to choose what to evict
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return out
+
+    def put(self, key, arrays, meta=None):
+        """Store dict of arrays under hashed key.
+
+        :param meta: optional dict describing the table (for bundle manifests)
+        """
+        if meta is not None:
+            arrays = dict(arrays, _meta=N.array(json.dumps(meta, sort_keys=True)))
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # possibly created by another process
+                if not os.path.isdir(self.directory):
+                    raise
+
+        tempname = os.path.join(
+            self.directory, '.temp_%s_%s.npz' % (key, uuid.uuid4().hex))
+        try:
+            with open(tempname, 'wb') as f:
+                N.savez(f, **arrays)
+            os.rename(tempname, self.filename(key))
+        finally:
+            deleteFile(tempname)
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is
+        smaller than the maximum size."""
+
+        if self.maxsize_bytes is None:
+            return
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname[:1] == '.' or fname[-4:] != '.npz':
+                continue
+            path = os.path.join(self.directory, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        entries.sort()
+        while entries and total > self.maxsize_bytes:
+            mtime, size, path = entries.pop(0)
+            deleteFile(path)
+            total -= size
+
+    def exportBundle(self, filename, keys):
+        """Write the tables for the hashed keys to a bundle file.
+
+        The bundle is not compressed, so that tables can be
+        memory-mapped when it is mounted.
+        """
+
+        entries = []
+        arrays = {}
+        missing = []
+        for key in sorted(set(keys)):
+            table = self.get(key)
+            if table is None:
+                missing.append(key)
+                continue
+            meta = None
+            if '_meta' in table:
+                meta = json.loads(str(table['_meta'][()]))
+            entries.append({'key': key, 'meta': meta})
+            for name, arr in table.items():
+                arrays['%s.%s' % (key, name)] = N.asarray(arr)
+        if missing:
+            raise RuntimeError(
+                'Cannot export tables not in cache: %s' % ', '.join(missing))
+
+        manifest = {
+            'version': bundleversion,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'tables': entries,
+            }
+        arrays['manifest'] = N.array(json.dumps(manifest, sort_keys=True))
+
+        tempname = '%s.temp_%s' % (filename, uuid.uuid4().hex)
+        try:
+            with open(tempname, 'wb') as f:
+                N.savez(f, **arrays)
+            os.rename(tempname, filename)
+        finally:
+            deleteFile(tempname)
+
+def tableSize(value):
+    """Estimate memory used by arrays in a table (which may be an
+    array, tuple, list, dict or object with array attributes)."""
+    if isinstance(value, N.ndarray):
+        return value.nbytes
+    elif isinstance(value, (tuple, list)):
+        return sum(tableSize(v) for v in value)
+    elif isinstance(value, dict):
+        return sum(tableSize(v) for v in value.values())
+    elif hasattr(value, '__dict__'):
+        return tableSize(vars(value))
+    return 0
+
+class MemoryCache:
+    """In-memory cache of tables, evicting the least recently used
+    tables to stay within a memory budget.
+
+    Keys should identify the table contents (e.g. from hashKey), so
+    that tables can be shared between users.
+    """
+
+    def __init__(self, maxsize_bytes=512*1024**2):
+        """
+        :param maxsize_bytes: maximum total size of tables
+        """
+        self.maxsize_bytes = maxsize_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return table for key, or None if not present."""
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # move to most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Add table for key, evicting old tables if necessary."""
+        size = tableSize(value)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size_bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.size_bytes += size
+
+            # always keep the newest table
+            while self.size_bytes > self.maxsize_bytes and len(self.entries) > 1:
+                oldkey, (oldval, oldsize) = self.entries.popitem(last=False)
+                self.size_bytes -= oldsize
+                self.evictions += 1
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def clear(self):
+        """Remove all tables."""
+        with self.lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        """Return dict of statistics (hits, misses, evictions, tables, size_bytes)."""
+        with self.lock:
+            return {
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'tables': len(self.entries),
+                'size_bytes': self.size_bytes,
+                }
+
+_memorycache = None
+
+def getMemoryCache():
+    """Return process-wide memory cache."""
+    global _memorycache
+    if _memorycache is None:
+        _memorycache = MemoryCache(
+            int(float(os.environ.get('MBPROJ2_MEMORY_CACHE_MB', 512))*1024**2))
+    return _memorycache
+
+_defaultcache = None
+
+def getDefaultCache():
+    """Return cache used by default, mounting any bundles in
+    MBPROJ2_TABLE_BUNDLES."""
+    global _defaultcache
+    if _defaultcache is None:
+        _defaultcache = TableCache()
+        bundles = os.environ.get('MBPROJ2_TABLE_BUNDLES')
+        if bundles:
+            for filename in bundles.split(os.pathsep):
+                _defaultcache.mountBundle(filename)
+    return _defaultcache
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Local server of count rate and flux tables, shared by several fits
+running on the same machine.
+
+The server owns the table cache and keeps the tables it has served in
+memory. Missing tables are built once: if several clients ask for the
+same table at the same time, one request builds it and the others wait
+for the result.
+
+Start the server with mbproj2-tableserver SOCKET (or python -m
+mbproj2.tableserver SOCKET), then set the environment variable
+MBPROJ2_TABLE_SERVER to SOCKET for the fitting processes. If the
+server cannot be contacted, or stops responding, tables are computed
+locally as usual.
+
+Requests and replies are pickled, so the socket is created accessible
+only to its owner.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import os
+import socket
+import struct
+import threading
+import pickle
+
+from six.moves import socketserver
+
+from .cosmo import Cosmology
+from . import tablecache
+from .utils import uprint
+
+# CountRate settings which change the tables
+_settings = ('Ttolerance', 'Tcoarsesteps', 'Tmaxrefine')
+
+# length of message follows as an unsigned 64 bit integer
+_lenfmt = '<Q'
+
+# while building tables, the server tells the client it is still busy
+# at this interval (seconds)
+_heartbeat = 5.
+
+def _sendMessage(sock, obj):
+    data = pickle.dumps(obj, protocol=2)
+    sock.sendall(struct.pack(_lenfmt, len(data)) + data)
+
+def _recvExactly(sock, nbytes):
+    chunks = []
+    while nbytes > 0:
+        chunk = sock.recv(min(nbytes, 1<<20))
+        if not chunk:
+            raise EOFError('Table server connection closed')
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b''.join(chunks)
+
+def _recvMessage(sock):
+    size = struct.unpack(
+        _lenfmt, _recvExactly(sock, struct.calcsize(_lenfmt)))[0]
+    return pickle.loads(_recvExactly(sock, size))
+
+def _absPath(filename):
+    """Absolute path of file (if it exists), as the server may have a
+    different working directory."""
+    if os.path.exists(filename):
+        return os.path.abspath(filename)
+    return filename
+
+class ConnectionFailed(RuntimeError):
+    """The table server could not be contacted or stopped responding."""
+
+class TableClient:
+    """Connection to a table server."""
+
+    # seconds to wait for the server to reply (it sends a reply every
+    # _heartbeat seconds while building tables)
+    timeout = 60.
+
+    def __init__(self, path):
+        """
+        :param path: filename of server socket
+        """
+        self.path = path
+
+    def request(self, kind, ctrate, keys):
+        """Get tables from the server.
+
+        :param kind: 'countrate', 'channelrate' or 'flux'
+        :param CountRate ctrate: object requesting the tables (giving the cosmology and settings)
+        :param keys: list of table keys (as for CountRate.storedCountTables etc)
+        :returns: list of dicts of arrays for each key
+        """
+
+        if kind == 'countrate':
+            keys = [k[:4] + (_absPath(k[4]), _absPath(k[5])) for k in keys]
+        elif kind == 'channelrate':
+            keys = [k[:2] + (_absPath(k[2]), _absPath(k[3])) for k in keys]
+
+        c = ctrate.cosmo
+        request = {
+            'kind': kind,
+            'keys': keys,
+            'cosmo': (c.z, c.H0, c.WM, c.WV),
+            'backend': ctrate.backend.name,
+            'settings': dict((s, getattr(ctrate, s)) for s in _settings),
+            }
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            _sendMessage(sock, request)
+            status = 'busy'
+            while status == 'busy':
+                status, result = _recvMessage(sock)
+        except (socket.error, EOFError) as e:
+            raise ConnectionFailed(str(e) or e.__class__.__name__)
+        finally:
+            sock.close()
+
+        if status == 'error':
+            raise result
+        return result
+
+_client = None
+_serving = False
+# servers which could not be used, so are not tried again
+_failedpaths = set()
+
+def getClient():
+    """Return TableClient for the server given by MBPROJ2_TABLE_SERVER,
+    or None if tables should be computed in this process."""
+    global _client
+
+    path = os.environ.get('MBPROJ2_TABLE_SERVER')
+    if _serving or not path or path in _failedpaths:
+        return None
+    if _client is None or _client.path != path:
+        if not os.path.exists(path):
+            uprint('Table server %s not found, computing tables locally' % path)
+            _failedpaths.add(path)
+            return None
+        _client = TableClient(path)
+    return _client
+
+def requestTables(kind, ctrate, keys):
+    """Get tables from the table server, if one is in use (see
+    TableClient.request).
+
+    :returns: list of tables, or None if they should be computed in this process
+    """
+    client = getClient()
+    if client is None:
+        return None
+    try:
+        return client.request(kind, ctrate, keys)
+    except ConnectionFailed as e:
+        uprint('Table server %s failed (%s), computing tables locally' % (
+            client.path, e))
+        _failedpaths.add(client.path)
+        return None
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            request = _recvMessage(self.request)
+        except EOFError:
+            return
+
+        reply = []
+        def build():
+            try:
+                reply.append(('ok', self.server.tableserver.getTables(request)))
+            except Exception as e:
+                reply.append(('error', e))
+
+        # build in another thread, telling the client we are still
+        # busy, so it can tell a slow build from a stuck server
+        thread = threading.Thread(target=build)
+        thread.daemon = True
+        thread.start()
+        try:
+            thread.join(_heartbeat)
+            while thread.is_alive():
+                _sendMessage(self.request, ('busy', None))
+                thread.join(_heartbeat)
+            _sendMessage(self.request, reply[0])
+        except socket.error:
+            # client has gone away (the tables are still kept)
+            pass
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class TableServer:
+    """Serve tables to clients over a Unix socket."""
+
+    def __init__(self, path, workers=None):
+        """
+        :param path: filename of socket
+        :param workers: maximum number of xspec processes used to build tables (default is the number of CPUs)
+        """
+        self.path = path
+        self.workers = workers
+
+        # tables already served, keyed by hash key
+        self.tables = tablecache.MemoryCache(
+            int(float(os.environ.get('MBPROJ2_MEMORY_CACHE_MB', 512))*1024**2))
+        # events for tables being built, keyed by hash key
+        self.building = {}
+        self.lock = threading.Lock()
+
+    def getTables(self, request):
+        """Return tables for a request from a client."""
+
+        from .countrate import CountRate
+
+        z, H0, WM, WV = request['cosmo']
+        ctrate = CountRate(Cosmology(z, H0=H0, WM=WM, WV=WV))
+        for name, val in request['settings'].items():
+            setattr(ctrate, name, val)
+        if ctrate.backend.name != request['backend']:
+            raise RuntimeError(
+                'Table server uses backend %s, not %s' % (
+                    ctrate.backend.name, request['backend']))
+
+        kind = request['kind']
+        keys = request['keys']
+        if kind == 'countrate':
+            hashkeys = [ctrate._hashKey(k) for k in keys]
+            stored = ctrate.storedCountTables
+        elif kind == 'channelrate':
+            hashkeys = [ctrate._channelHashKey(k) for k in keys]
+            stored = ctrate.storedChannelTables
+        elif kind == 'flux':
+            hashkeys = [ctrate._fluxHashKey(k) for k in keys]
+            stored = ctrate.storedFluxTables
+        else:
+            raise ValueError('Unknown table kind %s' % kind)
+
+        out = [self.tables.get(hk) for hk in hashkeys]
+
+        # claim the missing tables not already being built
+        claimed = []
+        waiting = []
+        with self.lock:
+            for i, hk in enumerate(hashkeys):
+                if out[i] is not None or hk in hashkeys[:i]:
+                    continue
+                if hk in self.building:
+                    waiting.append(self.building[hk])
+                else:
+                    self.building[hk] = threading.Event()
+                    claimed.append(i)
+
+        try:
+            if claimed:
+                tables = stored([keys[i] for i in claimed], workers=self.workers)
+                for i, table in zip(claimed, tables):
+                    self.tables.put(hashkeys[i], table)
+                    out[i] = table
+        finally:
+            with self.lock:
+                for i in claimed:
+                    self.building.pop(hashkeys[i]).set()
+
+        for event in waiting:
+            event.wait()
+
+        # tables built by other requests (or duplicates in this one),
+        # which are loaded from the table cache if they have been
+        # dropped from memory or their build failed
+        rest = [i for i, t in enumerate(out) if t is None]
+        for i in rest:
+            out[i] = self.tables.get(hashkeys[i])
+        rest = [i for i in rest if out[i] is None]
+        if rest:
+            for i, table in zip(
+                    rest, stored([keys[i] for i in rest], workers=self.workers)):
+                self.tables.put(hashkeys[i], table)
+                out[i] = table
+
+        return out
+
+    def serve(self):
+        """Serve requests until interrupted."""
+        global _serving
+        _serving = True
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # requests are unpickled, so no other user should ever be
+        # able to connect
+        oldumask = os.umask(0o177)
+        try:
+            server = _UnixServer(self.path, _Handler)
+        finally:
+            os.umask(oldumask)
+        server.tableserver = self
+
+        uprint('Serving tables on', self.path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            tablecache.deleteFile(self.path)
+
+def tableServerCmdLineParse():
+    parser = argparse.ArgumentParser(
+        description='Serve mbproj2 count rate tables to local fits')
+    parser.add_argument('socket', help='Filename of Unix socket')
+    parser.add_argument(
+        '--workers', type=int,
+        help='Number of processes to use (defaults to number of CPUs)')
+    args = parser.parse_args()
+
+    try:
+        TableServer(args.socket, workers=args.workers).serve()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    # use the copy of the module imported by the rest of mbproj2, so
+    # that it knows it is serving
+    from mbproj2 import tableserver
+    tableserver.tableServerCmdLineParse()
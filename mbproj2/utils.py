@@ -29,6 +29,7 @@ import sys
 import os
 import time
 import uuid
+import itertools
 
 def uprint(*args, **argsv):
     """Unbuffered print."""
@@ -57,12 +58,16 @@ def projectionVolume(R1, R2, y1, y2):
 
     return (2/3) * N.pi * ((p1**3 - p2**3) + (p4**3 - p3**3))
 
-def projectionVolumeMatrix(radii):
+def projectionVolumeMatrix(radii, shellradii=None):
     """Calculate volumes (front and back) using a matrix calculation.
 
     Dot matrix with emissivity array to compute projected surface
     brightnesses.
 
+    If shellradii is given, these are the edges of the shells, which
+    can differ from the edges of the annuli (radii). The matrix then
+    has shape (nannuli, nshells).
+
     Output looks like this:
     >>> utils.projectionVolumeMatrix(N.arange(5))
     array([[  4.1887902 ,   7.55593906,   6.57110358,   6.4200197 ],
@@ -72,13 +77,23 @@ def projectionVolumeMatrix(radii):
 
     """
 
-    i_s, j_s = N.indices((len(radii)-1, len(radii)-1))
+    if shellradii is None:
+        shellradii = radii
+    i_s, j_s = N.indices((len(radii)-1, len(shellradii)-1))
+    return projectionVolumeElements(radii, i_s, j_s, shellradii=shellradii)
+
+def projectionVolumeElements(radii, i_s, j_s, shellradii=None):
+    """Calculate elements of projectionVolumeMatrix for the annulus
+    indices i_s and shell indices j_s (arrays of the same shape)."""
 
+    if shellradii is None:
+        shellradii = radii
     radii_2 = radii**2
+    shellradii_2 = shellradii**2
     y1_2 = radii_2[i_s]
     y2_2 = radii_2[i_s+1]
-    R1_2 = radii_2[j_s]
-    R2_2 = radii_2[j_s+1]
+    R1_2 = shellradii_2[j_s]
+    R2_2 = shellradii_2[j_s+1]
 
     p1 = (R1_2-y2_2).clip(0)
     p2 = (R1_2-y1_2).clip(0)
@@ -87,6 +102,53 @@ def projectionVolumeMatrix(radii):
 
     return 2 * (2/3) * N.pi * ((p1**1.5 - p2**1.5) + (p4**1.5 - p3**1.5))
 
+def multilinearInterp(table, axes, coords, derivaxis=None):
+    """Multilinear interpolation in the trailing dimensions of a table.
+
+    :param table: array with shape (..., len(axes[0]), len(axes[1]), ...)
+    :param axes: list of increasing arrays of grid coordinates (single-valued axes are allowed)
+    :param coords: values to interpolate at for each axis (arrays broadcast together)
+    :param derivaxis: if set, return the derivative of the interpolated values with respect to the coordinate of this axis (zero outside the grid)
+
+    Coordinates outside the grid are clipped to the edges. The
+    output has the leading dimensions of the table followed by the
+    broadcast shape of the coordinates.
+    """
+
+    idxs = []
+    fracs = []
+    for axnum, (axis, x) in enumerate(zip(axes, coords)):
+        x = N.asarray(x, dtype=N.float64)
+        if len(axis) == 1:
+            if axnum == derivaxis:
+                return N.zeros(table.shape[:-len(axes)] + x.shape)
+            idxs.append(N.zeros(x.shape, dtype=N.intp))
+            fracs.append(None)
+        else:
+            i = N.clip(N.searchsorted(axis, x)-1, 0, len(axis)-2)
+            f = N.clip((x-axis[i]) / (axis[i+1]-axis[i]), 0., 1.)
+            idxs.append(i)
+            if axnum == derivaxis:
+                # weights become the derivatives of the fractions
+                inside = (x >= axis[0]) & (x <= axis[-1])
+                f = (f, inside / (axis[i+1]-axis[i]))
+            fracs.append(f)
+
+    # add up contributions from each corner of the enclosing cell
+    out = 0.
+    for corner in itertools.product(*[
+            (0,) if f is None else (0, 1) for f in fracs]):
+        weight = 1.
+        index = []
+        for axnum, (c, i, f) in enumerate(zip(corner, idxs, fracs)):
+            index.append(i+c)
+            if axnum == derivaxis:
+                weight = weight * (f[1] if c else -f[1])
+            elif f is not None:
+                weight = weight * (f if c else 1-f)
+        out = out + weight*table[(Ellipsis,)+tuple(index)]
+    return out
+
 def symmetriseErrors(data):
     """Take numpy-format data,+,- and convert to data,+-."""
     symerr = N.sqrt( 0.5*(data[:,1]**2 + data[:,2]**2) )
@@ -124,13 +186,66 @@ def readProfile(filename, column, cnvtfloat=True):
         out = N.array([float(x) for x in out])
     return out
 
+class CashLikelihood:
+    """Log likelihood of Cash statistic for fixed data.
+
+    The terms depending only on the data are computed once, and the
+    logarithm of the model is only taken in bins with counts. The
+    sums are accumulated in double precision, even if the model is
+    single precision.
+    """
+
+    def __init__(self, data):
+        """
+        :param data: array of counts (e.g. (nbands, nannuli) for all the bands)
+        """
+
+        data = N.asarray(data, dtype=N.float64).ravel()
+        self.size = len(data)
+        self.constant = N.sum(gammaln(data+1))
+
+        counts = data > 0
+        if N.all(counts):
+            self.countidx = self.zeroidx = None
+            self.data = data
+        else:
+            self.countidx = N.nonzero(counts)[0]
+            self.zeroidx = N.nonzero(~counts)[0]
+            self.data = data[self.countidx]
+
+    def __call__(self, model):
+        """Return log likelihood for model with the same shape as the
+        data."""
+
+        model = N.asarray(model).ravel()
+        if len(model) != self.size:
+            raise ValueError('Model has different size to data')
+
+        if self.countidx is None:
+            modelcts = model
+        else:
+            # zero-count bins only contribute -model
+            if N.any(model[self.zeroidx] < 0):
+                return -N.inf
+            modelcts = model[self.countidx]
+
+        like = (
+            N.dot(self.data, N.log(modelcts).astype(N.float64, copy=False)) -
+            N.sum(model, dtype=N.float64) - self.constant)
+        if N.isfinite(like):
+            return like
+        return -N.inf
+
 def cashLogLikelihood(data, model):
-    """Calculate log likelihood of Cash statistic."""
+    """Calculate log likelihood of Cash statistic.
+
+    If the same data are used repeatedly, CashLikelihood is faster."""
+    return CashLikelihood(data)(model)
 
-    like = N.sum(data * N.log(model)) - N.sum(model) - N.sum(gammaln(data+1))
-    if N.isfinite(like):
-        return like
-    return -N.inf
+def cashLogLikelihoodGrad(data, model):
+    """Derivative of Cash log likelihood with respect to the model in
+    each bin."""
+    return data/model - 1
 
 class WithLock:
     """Hacky lockfile class."""
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Precompute the tables needed by a set of yml configuration files.
+
+Running this before a batch of fits (e.g. for a sample of clusters)
+means that the jobs find their count rate, flux and PSF tables in the
+table cache, instead of each building them when they start.
+
+Installed as the mbproj2-warmcache command.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import os
+import multiprocessing
+import multiprocessing.pool
+
+import yaml
+
+from . import yml_driver
+from . import data
+from . import psfconvolve
+from . import tablecache
+from . import xspechelper
+from .utils import uprint
+
+# flux tables used when computing physical profiles (see phys module)
+fluxbands = [(0.01, 100.)]
+
+class _CosmoTables:
+    """Tables needed for a particular cosmology."""
+
+    def __init__(self, annuli):
+        self.ctrate = annuli.ctrate
+        self.keys = set()
+
+def warmCache(conffiles, workers=None, bundle=None):
+    """Compute any count rate, flux and PSF tables needed by the yml
+    configuration files which are not already in the table cache.
+
+    Count rate tables are computed with several xspec processes, while
+    the flux tables and PSF matrices are computed at the same time.
+
+    :param conffiles: list of yml filenames
+    :param workers: maximum number of xspec processes and PSF processes (default is the number of CPUs)
+    :param bundle: if set, export the tables to this bundle file (see tablecache)
+    """
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    # collect tables needed, grouped by cosmology
+    cosmotables = {}
+    psfs = {}
+    for conffile in conffiles:
+        uprint('Reading', conffile)
+        with open(conffile) as f:
+            ypars = yaml.safe_load(f)
+
+        annuli = yml_driver.constructAnnuli(ypars)
+        c = annuli.cosmology
+        ckey = (c.z, c.H0, c.WM, c.WV)
+        if ckey not in cosmotables:
+            cosmotables[ckey] = _CosmoTables(annuli)
+        tables = cosmotables[ckey]
+
+        NH = ypars['model']['params']['NH_1022pcm2']['val']
+        for b in ypars['bands']:
+            responses, respindex = data.uniqueResponses(
+                b['rmfs'], b['arfs'], annuli.nshells)
+            for rmf, arf in responses:
+                tables.keys.update(tables.ctrate.tableKeys(
+                    rmf, arf, b['emin_keV'], b['emax_keV'], NH))
+
+        psf = yml_driver.psfProfile(ypars)
+        if psf is not None:
+            args = (psf[0], psf[1], annuli.edges_arcmin)
+            psfs[psfconvolve.cachedPSFMatrixKey(*args)] = args
+
+    # report what is already available
+    ctkeys = [(t, k) for t in cosmotables.values() for k in t.keys]
+    ctmissing = [(t, k) for t, k in ctkeys if not t.ctrate.isTableCached(k)]
+    fluxmissing = [
+        (t, e) for t in cosmotables.values() for e in fluxbands
+        if not t.ctrate.isFluxTableCached(e)]
+    store = tablecache.getDefaultCache()
+    psfmissing = [args for key, args in psfs.items() if not store.contains(key)]
+
+    uprint('Count rate tables: %i needed, %i already cached' % (
+        len(ctkeys), len(ctkeys)-len(ctmissing)))
+    uprint('Flux tables: %i needed, %i already cached' % (
+        len(cosmotables)*len(fluxbands),
+        len(cosmotables)*len(fluxbands)-len(fluxmissing)))
+    uprint('PSF matrices: %i needed, %i already cached' % (
+        len(psfs), len(psfs)-len(psfmissing)))
+
+    # PSF matrices are computed in separate processes and flux tables
+    # in threads (each running xspec), while the count rate tables
+    # are built
+    psfpool = multiprocessing.Pool(min(workers, max(len(psfmissing), 1)))
+    psfresults = [
+        psfpool.apply_async(psfconvolve.cachedPSFMatrix, args)
+        for args in psfmissing]
+    psfpool.close()
+
+    fluxtables = set(t for t, e in fluxmissing)
+    fluxpool = multiprocessing.pool.ThreadPool(max(len(fluxtables), 1))
+    fluxresults = [
+        fluxpool.apply_async(t.ctrate.warmFluxCache, (fluxbands,))
+        for t in fluxtables]
+    fluxpool.close()
+
+    try:
+        for t in cosmotables.values():
+            keys = [k for tt, k in ctmissing if tt is t]
+            if keys:
+                uprint('Computing %i count rate tables at z=%g' % (
+                    len(keys), t.ctrate.cosmo.z))
+                t.ctrate.warmCountCache(keys, workers=workers)
+
+        # raises any exceptions from the other tables
+        for r in fluxresults + psfresults:
+            r.get()
+    finally:
+        fluxpool.join()
+        psfpool.join()
+
+    if bundle:
+        keys = set(psfs)
+        for t in cosmotables.values():
+            keys.update(t.ctrate.cacheKeys(t.keys, fluxbands))
+        uprint('Exporting %i tables to %s' % (len(keys), bundle))
+        store.exportBundle(bundle, keys)
+
+    timing = xspechelper.timingReport()
+    if timing:
+        uprint('Time taken by xspec commands:')
+        uprint(timing)
+
+    uprint('Done')
+
+def warmCacheCmdLineParse():
+    parser = argparse.ArgumentParser(
+        description='Precompute tables for mbproj2 yml configuration files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'conf', nargs='+', help='Input yml configuration files')
+    parser.add_argument(
+        '--workers', type=int,
+        help='Number of processes to use (defaults to number of CPUs)')
+    parser.add_argument(
+        '--export-bundle', metavar='FILE',
+        help='Export the tables to a bundle file for offline use')
+    parser.add_argument(
+        '--working-dir',
+        help='Working directory (defaults to current directory)')
+
+    args = parser.parse_args()
+
+    if args.working_dir:
+        os.chdir(args.working_dir)
+
+    warmCache(args.conf, workers=args.workers, bundle=args.export_bundle)
+
+if __name__ == '__main__':
+    warmCacheCmdLineParse()
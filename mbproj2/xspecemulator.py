@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""A stand-in for xspec, understanding the subset of commands sent by
+XSpecHelper.
+
+This is not a real plasma code. The emission is an analytic
+bremsstrahlung continuum plus a handful of metallicity-dependent
+lines, absorbed by an approximate photoelectric cross section and
+folded through an idealised detector. It is intended for testing and
+benchmarking without a HEASoft installation, not for science.
+
+The module has no dependencies on the rest of mbproj2, so it can be
+run directly as a script:
+
+  python /path/to/mbproj2/xspecemulator.py
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import re
+import sys
+import time
+
+import numpy as N
+
+# from physconstants (repeated so that this file runs standalone)
+keV_erg = 1.6021765e-09
+
+# energy grid used for integrating spectra (keV)
+egrid_keV = N.logspace(-2, 2, 4001)
+
+# continuum normalisation, photons cm^3 s^-1 keV^-1 keV^0.5 (per ne nH)
+brems_norm = 6e-15
+
+# lines: energy (keV), strength relative to continuum, log10 peak
+# temperature (keV) and width in log10 temperature
+emission_lines = (
+    (0.65, 2.0e-1, -0.6, 0.3),  # O VIII
+    (1.0, 1.5e-1, -0.1, 0.3),   # Fe L complex
+    (1.85, 3.0e-2, 0.1, 0.35),  # Si XIV
+    (2.45, 2.0e-2, 0.3, 0.35),  # S XVI
+    (6.7, 4.0e-2, 0.6, 0.4),    # Fe XXV
+)
+
+def integrate(y, x):
+    """Trapezium rule integration."""
+    return N.sum(0.5*(y[1:]+y[:-1])*N.diff(x))
+
+def apecSpectrum(E_keV, T_keV, Z_solar, redshift):
+    """Photon spectrum (photons cm^3 s^-1 keV^-1, per ne nH in the rest
+    frame) at the observed energies given, for the temperature,
+    metallicity and redshift given."""
+
+    E = N.asarray(E_keV) * (1+redshift)
+    T = max(T_keV, 1e-3)
+
+    # free-free continuum with a simple Gaunt factor
+    gaunt = 1 + 0.4*N.log1p(T/E)
+    spec = brems_norm * T**-0.5 * gaunt * N.exp(-E/T) / E
+
+    # metals add some continuum and Gaussian lines
+    spec *= 1 + 0.1*Z_solar
+    for Eline, strength, logTpeak, logTwidth in emission_lines:
+        emiss = (
+            Z_solar * strength * brems_norm * T**-0.5 * N.exp(-Eline/T) *
+            N.exp(-0.5*((N.log10(T)-logTpeak)/logTwidth)**2))
+        sigma = 0.02*Eline
+        spec = spec + emiss*N.exp(-0.5*((E-Eline)/sigma)**2)/(
+            sigma*N.sqrt(2*N.pi))
+
+    # time dilation
+    return spec / (1+redshift)
+
+def phabsTransmission(E_keV, NH_1022):
+    """Approximate photoelectric absorption transmission."""
+    sigma_cm2 = 2.0e-22 * N.asarray(E_keV)**(-8/3)
+    return N.exp(-NH_1022*1e22*sigma_cm2)
+
+def effectiveArea(E_keV):
+    """Effective area (cm^2) of the idealised detector."""
+    return 400. * N.exp(-0.5*(N.log(E_keV/1.5)/0.9)**2)
+
+class Emulator:
+    """Interpret commands read from a stream."""
+
+    # model parameters: nH, kT, abundance, redshift, norm
+    defpars = [1., 1., 1., 0., 1.]
+
+    putsre = re.compile(r'^puts\s+"(.*)"\s*$')
+    bracketre = re.compile(r'\[([^\]]*)\]')
+    varre = re.compile(r'\$(\w+)')
+
+    def __init__(self, outstream):
+        self.out = outstream
+        self.vars = {}
+        self.pars = None
+        self.mode = None
+        self.erange = (0.01, 100.)
+        self.lastflux = (0., 0.)
+        self.lasttick = time.time()
+        # depth of tcl blocks (e.g. the tcl input loop), which are skipped
+        self.depth = 0
+
+    def modelSpectrum(self):
+        """Model photon flux (photons cm^-2 s^-1 keV^-1) on egrid."""
+        NH, T, Z, z, norm = self.pars
+        return (
+            norm * 1e14 * apecSpectrum(egrid_keV, T, Z, z) *
+            phabsTransmission(egrid_keV, NH))
+
+    def inRange(self, emin, emax):
+        return (egrid_keV >= emin) & (egrid_keV <= emax)
+
+    def rate(self):
+        """Count rate in current energy range."""
+        if self.pars is None or self.mode != 'fakeit':
+            return 0.
+        sel = self.inRange(*self.erange)
+        return integrate(
+            (self.modelSpectrum()*effectiveArea(egrid_keV))[sel],
+            egrid_keV[sel])
+
+    def flux(self, emin, emax):
+        """Energy and photon flux between energies given."""
+        if self.pars is None:
+            return 0., 0.
+        sel = self.inRange(emin, emax)
+        spec = self.modelSpectrum()[sel]
+        e = egrid_keV[sel]
+        return integrate(spec*e, e)*keV_erg, integrate(spec, e)
+
+    def tick(self):
+        """Microseconds since tick was last called."""
+        now = time.time()
+        dt = int((now-self.lasttick)*1e6)
+        self.lasttick = now
+        return dt
+
+    def tclout(self, cmd):
+        """Return result of tclout/tcloutr (or tick) command."""
+        args = cmd.split()
+        if args[0] == 'tick':
+            return str(self.tick())
+        elif args[1] == 'rate':
+            r = self.rate()
+            return '%e %e %e %e' % (r, 0., r, 100.)
+        elif args[1] == 'flux':
+            eflux, pflux = self.lastflux
+            return '%e %e %e %e %e %e' % (eflux, eflux, eflux, pflux, pflux, pflux)
+        return ''
+
+    def substitute(self, text):
+        text = self.bracketre.sub(lambda m: self.tclout(m.group(1)), text)
+        return self.varre.sub(lambda m: self.vars.get(m.group(1), ''), text)
+
+    def command(self, line):
+        """Process a single line. Returns False if exiting."""
+
+        line = line.strip()
+        args = line.split()
+        if not args:
+            return True
+        cmd = args[0]
+
+        if cmd != 'puts':
+            # skip over tcl control structures
+            depth = self.depth
+            self.depth += line.count('{') - line.count('}')
+            if depth > 0 or self.depth > 0:
+                return True
+
+        if cmd == 'tclexit':
+            return False
+        elif cmd == 'set' and len(args) >= 3:
+            self.vars[args[1]] = ' '.join(args[2:])
+        elif cmd == 'model':
+            if args[1:] == ['none']:
+                self.pars = None
+            else:
+                vals = [float(x) for x in line.split('&')[1:]]
+                self.pars = vals + self.defpars[len(vals):]
+        elif cmd == 'newpar' and self.pars is not None:
+            self.pars[int(args[1])-1] = float(args[2])
+        elif cmd == 'fakeit':
+            self.mode = 'fakeit'
+            self.erange = (0.01, 100.)
+        elif cmd == 'dummyrsp':
+            self.mode = 'dummy'
+            self.erange = (float(args[1]), float(args[2]))
+        elif cmd == 'ignore':
+            m = re.match(r'\*\*:\*\*-([0-9.eE+-]+),([0-9.eE+-]+)-\*\*', args[1])
+            if m:
+                self.erange = (float(m.group(1)), float(m.group(2)))
+        elif cmd == 'tick':
+            self.tick()
+        elif cmd == 'flux':
+            self.lastflux = self.flux(float(args[1]), float(args[2]))
+        elif cmd == 'puts':
+            m = self.putsre.match(line)
+            text = m.group(1) if m else ' '.join(args[1:])
+            self.out.write(self.substitute(text) + '\n')
+            self.out.flush()
+        # anything else (tcl loop, autosave, data, ...) is ignored
+        return True
+
+    def run(self, instream):
+        for line in iter(instream.readline, ''):
+            if not self.command(line):
+                break
+
+def main():
+    Emulator(sys.stdout).run(sys.stdin)
+
+if __name__ == '__main__':
+    main()
@@ -19,19 +19,30 @@
 """Module to interrogate xspec to get count rates and luminosities
 given model parameters.
 
+Each batch of commands sent to xspec ends with a numbered sentinel
+line, which the helper waits for, so the output stream is always in a
+known state. The time taken for each kind of command is recorded (see
+timingReport).
 """
 
 from __future__ import division, print_function, absolute_import
 
 import subprocess
 import os
-import select
 import atexit
 import re
 import sys
+import threading
+import time
+import tempfile
+import uuid
 from math import pi
 import signal
 
+from six.moves import queue
+
+import numpy as N
+
 from .physconstants import Mpc_cm, ne_nH
 from . import cosmo
 
@@ -45,6 +56,42 @@ def deleteFile(filename):
 # keep track of xspec invocations which need finishing
 _finishatexit = []
 
+# total time taken by xspec commands, by type of command:
+#  label -> [count, total time, maximum time]
+_timings = {}
+_timingslock = threading.Lock()
+
+def recordTime(label, seconds):
+    """Add time taken by xspec command to timing statistics."""
+    with _timingslock:
+        t = _timings.setdefault(label, [0, 0., 0.])
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+
+def timingReport():
+    """Return text summarising time taken by xspec commands."""
+    with _timingslock:
+        lines = [
+            '%-12s %8i calls, mean %8.2f ms, max %8.2f ms' % (
+                label, t[0], t[1]/t[0]*1e3, t[2]*1e3)
+            for label, t in sorted(_timings.items())]
+    return '\n'.join(lines)
+
+# tcl procedure returning the time in microseconds since it was last
+# called, so that the time taken by each command in a script is
+# measured by xspec, rather than when we read its result
+tcltick = '''
+set LASTTICK [clock clicks -microseconds]
+proc tick {} {
+ global LASTTICK
+ set now [clock clicks -microseconds]
+ set dt [expr {$now - $LASTTICK}]
+ set LASTTICK $now
+ return $dt
+}
+'''
+
 # tcl code to do an infinite evaluation of commands until end
 tclloop = '''
 autosave off
@@ -64,10 +111,16 @@ class XSpecHelper:
     specialre = re.compile('%s (.*) %s' % (specialcode, specialcode))
     normfactor = 1e75 # multiply norm by this to get into sensible units in xspec
 
-    def __init__(self):
+    def __init__(self, command=None):
+        """
+        :param command: command line to run (default ['xspec']), which
+          could instead be a program understanding the same protocol
+        """
+        if command is None:
+            command = ['xspec']
         try:
             self.xspecsub = subprocess.Popen(
-                ['xspec'],
+                list(command),
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 bufsize=1,
@@ -76,11 +129,16 @@ class XSpecHelper:
         except OSError:
             raise RuntimeError('Failed to start xspec')
 
-        self.throwAwayOutput()
-        self.tempoutput = None
+        # count of sentinels written
+        self.syncs = 0
+
+        # unique name, so that several helpers can run at the same time
+        self.tempoutput = os.path.join(
+            tempfile.gettempdir(), 'jsproj_temp_%s.fak' % uuid.uuid4().hex)
         _finishatexit.append(self)
 
         self.write('set SCODE %s\n' % self.specialcode)
+        self.write(tcltick)
 
         # debugging
         logfile = os.path.join(os.environ['HOME'], 'xspec.log.%i' % id(self))
@@ -91,19 +149,49 @@ class XSpecHelper:
         # closes its stdin
         self.write(tclloop)
 
+        # wait for startup to finish
+        self.sync()
+
     def write(self, text):
         self.xspecsub.stdin.write(text)#.encode('utf-8'))
 
-    def throwAwayOutput(self):
-        """Ignore output from program until no more data available."""
-        while True:
-            i, o, e = select.select([self.xspecsub.stdout.fileno()], [], [], 0)
-            if i:
-                t = os.read(i[0], 1024)
-                if not t:  # file was closed
-                    break
-            else:
-                break
+    def sentinel(self):
+        """Return command to write a new sentinel, and the result
+        expected from it."""
+        self.syncs += 1
+        result = 'sync %i' % self.syncs
+        # the code is not written literally, in case xspec echoes
+        # the command
+        return 'puts "$SCODE %s $SCODE"\n' % result, result
+
+    def sync(self):
+        """Write a sentinel and wait until xspec outputs it, so that
+        all previous commands have been processed."""
+        cmd, expected = self.sentinel()
+        self.write(cmd)
+        self.waitFor(expected)
+
+    def waitFor(self, expected):
+        """Read results until the one expected."""
+        result = self.readResult()
+        if result != expected:
+            raise RuntimeError(
+                'Unexpected result from xspec: %s (expecting %s)' % (
+                    repr(result), repr(expected)))
+
+    def command(self, text, label=None):
+        """Write commands to xspec and wait until they have been
+        processed, recording the time taken.
+
+        :param text: commands, ending in a new line
+        :param label: name for timing statistics (default is first command)
+        """
+        if label is None:
+            label = text.split()[0]
+        start = time.time()
+        self.write(text)
+        self.sync()
+        recordTime(label, time.time()-start)
 
     def readResult(self):
         """Return result from xspec."""
@@ -111,66 +199,219 @@ class XSpecHelper:
         while not search:
             line = self.xspecsub.stdout.readline()
             #line = line.decode('utf-8')
+            if not line:
+                raise RuntimeError('xspec exited unexpectedly')
             search = XSpecHelper.specialre.search(line)
         return search.group(1)
 
+    def readResults(self, num):
+        """Return num results from xspec, keyed by the index written
+        as the first item in each result."""
+        results = {}
+        while len(results) < num:
+            idx, val = self.readResult().split(None, 1)
+            results[int(idx)] = val
+        return results
+
+    def runScript(self, script, num, label='script'):
+        """Write the script to xspec and return num indexed results.
+
+        The script is written from a separate thread, so that xspec
+        does not block on a full output pipe while we are still
+        writing commands.
+
+        Each result should be written as
+        puts "$SCODE index [tick] value $SCODE", where tick gives the
+        time xspec took for the commands since the previous result,
+        which is recorded under the label given.
+        """
+        cmd, expected = self.sentinel()
+        writer = threading.Thread(
+            target=self.write, args=('tick\n'+script+cmd,))
+        writer.start()
+        try:
+            results = {}
+            while len(results) < num:
+                idx, dt, val = self.readResult().split(None, 2)
+                results[int(idx)] = val
+                recordTime(label, int(dt)*1e-6)
+            self.waitFor(expected)
+        finally:
+            writer.join()
+        return results
+
     def setModel(self, NH_1022, T_keV, Z_solar, cosmo, ne_cm3):
         """Make a model with column density, temperature and density given."""
-        self.write('model none\n')
         norm = 1e-14 / 4 / pi / (cosmo.D_A*Mpc_cm * (1.+cosmo.z))**2 * ne_cm3**2 / ne_nH
-        self.write('model phabs(apec) & %g & %g & %g & %g & %g\n' %
-            (NH_1022, T_keV, Z_solar, cosmo.z, norm*XSpecHelper.normfactor))
-        self.throwAwayOutput()
+        self.command(
+            'model none\n'
+            'model phabs(apec) & %g & %g & %g & %g & %g\n' %
+            (NH_1022, T_keV, Z_solar, cosmo.z, norm*XSpecHelper.normfactor),
+            label='model')
 
     def changeResponse(self, rmf, arf, minenergy_keV, maxenergy_keV):
         """Create a fake spectrum using the response and use energy range given."""
 
         self.setModel(0.1, 1, 1, cosmo.Cosmology(0.1), 1.)
-        self.tempoutput = '/tmp/jsproj_temp_%i.fak' % os.getpid()
         deleteFile(self.tempoutput)
-        self.write('data none\n')
-        self.write('fakeit none & %s & %s & y & foo & %s & 1.0\n' %
-            (rmf, arf, self.tempoutput))
+        self.command(
+            'data none\n'
+            'fakeit none & %s & %s & y & foo & %s & 1.0\n' %
+            (rmf, arf, self.tempoutput), label='fakeit')
 
         # this is the range we are interested in getting rates for
-        self.write('ignore **:**-%f,%f-**\n' % (minenergy_keV, maxenergy_keV))
-        self.throwAwayOutput()
+        self.command(
+            'ignore **:**-%f,%f-**\n' % (minenergy_keV, maxenergy_keV))
 
     def dummyResponse(self):
         """Make a wide-energy band dummy response."""
-        self.write('data none\n')
-        self.write('dummyrsp 0.01 100. 1000\n')
-        self.throwAwayOutput()
+        self.command('data none\ndummyrsp 0.01 100. 1000\n', label='dummyrsp')
 
     def getCountsPerSec(self, NH_1022, T_keV, Z_solar, cosmo, ne_cm3):
         """Return number of counts per second given parameters."""
         self.setModel(NH_1022, T_keV, Z_solar, cosmo, ne_cm3)
-        self.write('puts "$SCODE [tcloutr rate 1] $SCODE"\n')
-        #self.xspecsub.stdin.flush()
-        retn = self.readResult()
+        retn = self.runScript(
+            'puts "$SCODE 0 [tick] [tcloutr rate 1] $SCODE"\n', 1, label='rate')[0]
         modelrate = float( retn.split()[2] ) / XSpecHelper.normfactor
         return modelrate
 
+    def getCountsPerSecGrid(self, NH_1022, T_keV, Z_solar, cosmo, ne_cm3):
+        """Return count rates for every combination of the temperatures
+        and metallicities given.
+
+        The commands for the whole grid are written as a single
+        script and the results parsed from the output stream, rather
+        than doing a round trip for each point.
+
+        :returns: array of rates with shape (len(Z_solar), len(T_keV))
+        """
+        self.setModel(NH_1022, T_keV[0], Z_solar[0], cosmo, ne_cm3)
+        script = []
+        idx = 0
+        for Z in Z_solar:
+            script.append('newpar 3 %g\n' % Z)
+            for T in T_keV:
+                script.append('newpar 2 %g\n' % T)
+                script.append(
+                    'puts "$SCODE %i [tick] [tcloutr rate 1] $SCODE"\n' % idx)
+                idx += 1
+
+        results = self.runScript(''.join(script), idx, label='rate')
+        rates = N.array([
+            float(results[i].split()[2]) for i in range(idx)])
+        return rates.reshape(len(Z_solar), len(T_keV)) / XSpecHelper.normfactor
+
     def getFlux(self, T_keV, Z_solar, cosmo, ne_cm3, emin_keV=0.01, emax_keV=100.):
         """Get flux in erg cm^-2 s^-1 from parcel of gas with the above parameters.
         emin_keV and emax_keV are the energy bounds
         """
         self.setModel(0., T_keV, Z_solar, cosmo, ne_cm3)
-        self.write('flux %e %e\n' % (emin_keV, emax_keV))
-        self.write('puts "$SCODE [tcloutr flux] $SCODE"\n')
-        flux = float( self.readResult().split()[0] ) / XSpecHelper.normfactor
+        retn = self.runScript(
+            'flux %e %e\n'
+            'puts "$SCODE 0 [tick] [tcloutr flux] $SCODE"\n' % (emin_keV, emax_keV),
+            1, label='flux')[0]
+        flux = float( retn.split()[0] ) / XSpecHelper.normfactor
         return flux
 
+    def getFluxGrid(self, T_keV, Z_solar, cosmo, ne_cm3,
+                    emin_keV=0.01, emax_keV=100.):
+        """Get fluxes in erg cm^-2 s^-1 for every combination of the
+        temperatures and metallicities given, using a single script.
+
+        :returns: array of fluxes with shape (len(Z_solar), len(T_keV))
+        """
+        return self.getFluxGrids(
+            T_keV, Z_solar, cosmo, ne_cm3, [(emin_keV, emax_keV)])[0]
+
+    def getFluxGrids(self, T_keV, Z_solar, cosmo, ne_cm3, ebands):
+        """Get fluxes in several energy bands for every combination
+        of the temperatures and metallicities given, using a single
+        script.
+
+        :param ebands: list of (emin_keV, emax_keV)
+        :returns: array of fluxes with shape (len(ebands), len(Z_solar), len(T_keV))
+        """
+        self.setModel(0., T_keV[0], Z_solar[0], cosmo, ne_cm3)
+        script = []
+        idx = 0
+        for Z in Z_solar:
+            script.append('newpar 3 %g\n' % Z)
+            for T in T_keV:
+                script.append('newpar 2 %g\n' % T)
+                for emin_keV, emax_keV in ebands:
+                    script.append('flux %e %e\n' % (emin_keV, emax_keV))
+                    script.append(
+                        'puts "$SCODE %i [tick] [tcloutr flux] $SCODE"\n' % idx)
+                    idx += 1
+
+        results = self.runScript(''.join(script), idx, label='flux')
+        fluxes = N.array([
+            float(results[i].split()[0]) for i in range(idx)])
+        fluxes = fluxes.reshape(len(Z_solar), len(T_keV), len(ebands))
+        return N.moveaxis(fluxes, 2, 0) / XSpecHelper.normfactor
+
     def finish(self):
         self.write('tclexit\n')
-        #self.xspecsub.stdin.flush()
-        self.throwAwayOutput()
+        self.xspecsub.stdin.close()
+        # read any remaining output until xspec exits
+        self.xspecsub.stdout.read()
         self.xspecsub.stdout.close()
         self.xspecsub.wait()
-        if self.tempoutput:
-            deleteFile(self.tempoutput)
+        deleteFile(self.tempoutput)
         del _finishatexit[ _finishatexit.index(self) ]
 
+class XSpecPool:
+    """A pool of persistent xspec processes, each driven by its own
+    thread, for computing several tables at the same time."""
+
+    def __init__(self, workers, command=None):
+        """
+        :param int workers: number of xspec processes to start
+        :param command: command line to run for each process (see XSpecHelper)
+        """
+        self.xspecs = [XSpecHelper(command=command) for i in range(workers)]
+
+    def map(self, func, args):
+        """Return list of func(xspec, arg) for each item in args,
+        spreading the calls over the xspec processes."""
+
+        args = list(args)
+        results = [None]*len(args)
+        errors = []
+
+        todo = queue.Queue()
+        for item in enumerate(args):
+            todo.put(item)
+
+        def worker(xspec):
+            while not errors:
+                try:
+                    idx, arg = todo.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    results[idx] = func(xspec, arg)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [
+            threading.Thread(target=worker, args=(xspec,))
+            for xspec in self.xspecs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def finish(self):
+        """Close all the xspec processes."""
+        for xspec in self.xspecs:
+            xspec.finish()
+        self.xspecs = []
+
 def _finishXSpecs():
     """Finish any remaining xspecs if finish() does not get called above."""
     while _finishatexit:
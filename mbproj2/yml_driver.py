@@ -38,6 +38,7 @@ from . import helpers
 from . import phys
 from . import mcmc
 from . import param
+from . import psfconvolve
 from .utils import uprint
 
 def readProfile(arg):
@@ -64,11 +65,33 @@ def constructAnnuli(pars):
 
     cos = cosmo.Cosmology(pars['model']['params']['redshift']['val'])
 
-    return data.Annuli(N.concatenate(([centre[0]-hw[0]], centre+hw)), cos)
+    # optional separate (e.g. coarser) shells for the model
+    shells = None
+    if 'shelledges' in p:
+        shells = data.Annuli(readProfile(p['shelledges']), cos)
+
+    return data.Annuli(
+        N.concatenate(([centre[0]-hw[0]], centre+hw)), cos,
+        projection=p.get('projection', 'dense'),
+        projbandwidth=p.get('projbandwidth'),
+        shells=shells)
+
+def psfProfile(pars):
+    """Return PSF edges and values if given in the optional psf
+    section, or None."""
+    if 'psf' not in pars:
+        return None
+    return readProfile(pars['psf']['edges']), readProfile(pars['psf']['val'])
 
 def constructData(pars, annuli):
     """Construct a data object."""
 
+    psfmatrix = None
+    psf = psfProfile(pars)
+    if psf is not None:
+        psfmatrix = psfconvolve.cachedPSFMatrix(
+            psf[0], psf[1], annuli.edges_arcmin)
+
     areascales = readProfile(pars['radii']['areas']) / (
         N.pi * (annuli.edges_arcmin[1:]**2 - annuli.edges_arcmin[:-1]**2))
 
@@ -86,7 +109,8 @@ def constructData(pars, annuli):
             b['rmfs'], b['arfs'],
             readProfile(b['exposures']),
             backrates=back,
-            areascales=areascales)
+            areascales=areascales,
+            psfmatrix=psfmatrix)
         bands.append(band)
 
     return data.Data(bands, annuli)
@@ -228,7 +252,8 @@ class YMLDriver:
     """Class wraps behaviour of mbproj1."""
 
     def __init__(self, inyml, threads=None):
-        self.ypars = yaml.load(open(inyml))
+        # configs are plain data, so no Python objects are constructed
+        self.ypars = yaml.safe_load(open(inyml))
 
         self.name = self.ypars['main']['name']
         self.chainfilename = '%s_mbp2_chain.hdf5' % self.name
@@ -236,7 +261,9 @@ class YMLDriver:
 
         self.annuli = constructAnnuli(self.ypars)
         self.data = constructData(self.ypars, self.annuli)
-        self.model, self.pars = constructModel(self.ypars, self.annuli)
+        self.model, self.pars = constructModel(
+            self.ypars,
+            self.annuli if self.annuli.shells is None else self.annuli.shells)
 
         # optional background normalisation scaling
         if 'backscale' in self.ypars['model']['params']:
@@ -19,7 +19,7 @@
 # MA 02111-1307, USA
 
 from __future__ import division, print_function
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='mbproj2',
@@ -40,7 +40,15 @@ setup(
 
     extras_require = {
         'Plotting': ['veusz'],
+        'Responses': ['astropy'],
         },
 
     packages=['mbproj2'],
+
+    entry_points = {
+        'console_scripts': [
+            'mbproj2-warmcache = mbproj2.warmcache:warmCacheCmdLineParse',
+            'mbproj2-tableserver = mbproj2.tableserver:tableServerCmdLineParse',
+            ],
+        },
     )
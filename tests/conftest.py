@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+from __future__ import division, print_function, absolute_import
+
+import pytest
+
+from mbproj2 import countrate, ratebackend, tablecache
+
+@pytest.fixture(scope='session')
+def cachedir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('cache'))
+
+@pytest.fixture
+def emulator(cachedir, monkeypatch):
+    """Compute tables with the xspec emulator, in a cache private to
+    the tests, so that xspec is not needed."""
+    monkeypatch.setattr(
+        countrate.CountRate, 'backend', ratebackend.EmulatorBackend())
+    monkeypatch.setattr(
+        tablecache, '_defaultcache', tablecache.TableCache(cachedir))
+    monkeypatch.delenv('MBPROJ2_TABLE_SERVER', raising=False)
+    monkeypatch.delenv('MBPROJ2_TABLE_BUNDLES', raising=False)
+
+@pytest.fixture(scope='session')
+def responses(tmp_path_factory):
+    """Names of dummy rmf and arf files (the emulator ignores their
+    contents, but they must exist)."""
+    directory = tmp_path_factory.mktemp('responses')
+    names = {}
+    for name in ('test.rmf', 'test2.rmf', 'test.arf'):
+        filename = str(directory / name)
+        with open(filename, 'w') as f:
+            f.write(name)
+        names[name] = filename
+    return names
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Check that Annuli keep their own count rate settings."""
+
+from __future__ import division, print_function, absolute_import
+
+import pickle
+
+import numpy as N
+import pytest
+
+import mbproj2 as mb
+
+def makeFit(responses, **ctratesettings):
+    annuli = mb.Annuli(N.linspace(0.1, 4, 11), mb.Cosmology(0.1))
+    for name, val in ctratesettings.items():
+        setattr(annuli.ctrate, name, val)
+
+    ne = mb.CmptBeta('ne', annuli)
+    T = mb.CmptFlat('T', annuli, defval=0.5, log=True)
+    Z = mb.CmptFlat('Z', annuli, defval=0.3)
+    model = mb.ModelNullPot(annuli, ne, T, Z, NH_1022pcm2=0.03)
+
+    rs = N.random.RandomState(3)
+    bands = [
+        mb.Band(
+            emin, emax, rs.poisson(50, 10).astype(float),
+            responses['test.rmf'], responses['test.arf'], 1e5,
+            backrates=1e-5)
+        for emin, emax in ((0.5, 1.2), (1.2, 2.5))]
+    return mb.Fit(model.defPars(), model, mb.Data(bands, annuli))
+
+def calcLike(fit):
+    return fit.likeFromProfs(fit.calcProfiles())
+
+def test_separate_ctrate():
+    cosmo = mb.Cosmology(0.1)
+    annuli1 = mb.Annuli(N.linspace(0.1, 4, 11), cosmo)
+    annuli2 = mb.Annuli(N.linspace(0.1, 4, 11), cosmo)
+    assert annuli1.ctrate is not annuli2.ctrate
+
+    # re-gridding keeps the count rate helper unless the cosmology changes
+    ctrate = annuli1.ctrate
+    annuli1.update(N.linspace(0.1, 4, 21), cosmo)
+    assert annuli1.ctrate is ctrate
+    annuli1.update(N.linspace(0.1, 4, 21), cosmo.withRedshift(0.2))
+    assert annuli1.ctrate is not ctrate
+    assert annuli1.ctrate.cosmo.z == 0.2
+
+def test_settings_not_shared(emulator, responses):
+    default = calcLike(makeFit(responses))
+    gridded = calcLike(makeFit(
+        responses, NHgrid_1022pcm2=[0.01, 0.05], zgrid=[0.05, 0.15]))
+    adaptive = calcLike(makeFit(responses, Ttolerance=0.2))
+    assert gridded != pytest.approx(default, rel=1e-9, abs=0)
+    assert adaptive != pytest.approx(default, rel=1e-9, abs=0)
+
+    # a later default fit is not affected by the others
+    assert calcLike(makeFit(responses)) == default
+
+def test_pickle_settings():
+    annuli = mb.Annuli(N.linspace(0.1, 4, 11), mb.Cosmology(0.1))
+    annuli.ctrate.zgrid = [0.05, 0.15]
+    copy = pickle.loads(pickle.dumps(annuli))
+    assert copy.ctrate.zgrid == [0.05, 0.15]
+    assert len(copy.ctrate.stackcache) == 0
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Compare count rates from the xspec emulator and from folding the
+same spectra through equivalent responses."""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+import pytest
+
+from mbproj2 import ratebackend, responsefold, xspecemulator
+from mbproj2.cosmo import Cosmology
+
+fits = pytest.importorskip('astropy.io.fits')
+
+def writeDiagonalResponse(rmf, arf, edges):
+    """Write a diagonal response with the effective area of the
+    emulator's idealised detector."""
+
+    elo, ehi = edges[:-1], edges[1:]
+    n = len(elo)
+    matrix = fits.BinTableHDU.from_columns([
+        fits.Column('ENERG_LO', 'E', array=elo),
+        fits.Column('ENERG_HI', 'E', array=ehi),
+        fits.Column('N_GRP', 'J', array=N.ones(n)),
+        fits.Column('F_CHAN', 'PJ()', array=[[i+1] for i in range(n)]),
+        fits.Column('N_CHAN', 'PJ()', array=[[1]]*n),
+        fits.Column('MATRIX', 'PE()', array=[[1.]]*n),
+        ], name='MATRIX')
+    matrix.header['TLMIN4'] = 1
+    ebounds = fits.BinTableHDU.from_columns([
+        fits.Column('CHANNEL', 'J', array=N.arange(n)+1),
+        fits.Column('E_MIN', 'E', array=elo),
+        fits.Column('E_MAX', 'E', array=ehi),
+        ], name='EBOUNDS')
+    fits.HDUList([fits.PrimaryHDU(), matrix, ebounds]).writeto(rmf)
+
+    specresp = fits.BinTableHDU.from_columns([
+        fits.Column('ENERG_LO', 'E', array=elo),
+        fits.Column('ENERG_HI', 'E', array=ehi),
+        fits.Column(
+            'SPECRESP', 'E',
+            array=xspecemulator.effectiveArea(0.5*(elo+ehi))),
+        ], name='SPECRESP')
+    fits.HDUList([fits.PrimaryHDU(), specresp]).writeto(arf)
+
+def test_emulator_fold(tmp_path):
+    rmf, arf = str(tmp_path / 'diag.rmf'), str(tmp_path / 'diag.arf')
+    writeDiagonalResponse(rmf, arf, N.linspace(0.1, 12., 2381))
+
+    cosmo = Cosmology(0.1)
+    T_keV = N.array([0.8, 2., 5., 10.])
+    keys = [
+        (0.5, 1.2, 0.1, 0.03, rmf, arf),
+        (1.2, 2.5, 0.1, 0.03, rmf, arf),
+        (2.5, 7., 0.2, 0.1, rmf, arf),
+        ]
+
+    fold = ratebackend.FoldBackend(responsefold.EmulatorSpectra())
+    emulator = ratebackend.EmulatorBackend()
+    foldrates = fold.countRateTables(keys, T_keV, cosmo, workers=1)
+    emurates = emulator.countRateTables(keys, T_keV, cosmo, workers=1)
+
+    for f, e in zip(foldrates, emurates):
+        assert f.shape == e.shape == (2, len(T_keV))
+        assert N.allclose(f, e, rtol=0.02, atol=0)
+
+def test_emulator_flux():
+    cosmo = Cosmology(0.1)
+    T_keV = N.array([1., 4.])
+    ebands = [(0.5, 2.), (0.01, 100.)]
+    fold = ratebackend.FoldBackend(responsefold.EmulatorSpectra())
+    emulator = ratebackend.EmulatorBackend()
+    foldflux = fold.fluxTables(T_keV, cosmo, ebands)
+    emuflux = emulator.fluxTables(T_keV, cosmo, ebands)
+    assert N.allclose(foldflux, emuflux, rtol=0.02, atol=0)
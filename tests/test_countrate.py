@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Check count rates interpolated in column density and redshift."""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+import pytest
+
+import mbproj2 as mb
+
+def makeFit(responses, NHpar, z=0.1):
+    annuli = mb.Annuli(N.linspace(0.1, 4, 11), mb.Cosmology(z))
+    annuli.ctrate.NHgrid_1022pcm2 = [0.01, 0.05]
+    annuli.ctrate.zgrid = [0.05, 0.15]
+
+    ne = mb.CmptBeta('ne', annuli)
+    T = mb.CmptFlat('T', annuli, defval=0.5, log=True)
+    Z = mb.CmptFlat('Z', annuli, defval=0.3)
+    model = mb.ModelNullPot(annuli, ne, T, Z, NH_1022pcm2=0.03)
+    pars = model.defPars()
+    pars['NH_1022pcm2'] = NHpar
+
+    band = mb.Band(
+        0.5, 2., N.full(10, 50.), responses['test.rmf'],
+        responses['test.arf'], 1e5, backrates=1e-5)
+    return mb.Fit(pars, model, mb.Data([band], annuli))
+
+def test_nh_parameter_range(emulator, responses):
+    fit = makeFit(responses, mb.Param(0.03, minval=0.01, maxval=0.05))
+    assert N.isfinite(fit.likeFromProfs(fit.calcProfiles()))
+
+    # a frozen parameter only needs its value on the grid
+    makeFit(responses, mb.Param(0.03, frozen=True))
+
+    for par in (mb.Param(0.03), mb.Param(0.03, minval=0., maxval=0.05)):
+        with pytest.raises(RuntimeError, match='NHgrid_1022pcm2'):
+            makeFit(responses, par)
+
+def test_outside_grid(emulator, responses):
+    fit = makeFit(responses, mb.Param(0.03, minval=0.01, maxval=0.05))
+    ctrate = fit.data.annuli.ctrate
+    band = [(responses['test.rmf'], responses['test.arf'], 0.5, 2.)]
+    T, Z, ne = N.array([2.]), N.array([0.3]), N.array([1e-3])
+    ctrate.getCountRates(band, 0.05, T, Z, ne)
+
+    with pytest.raises(RuntimeError, match='column density'):
+        ctrate.getCountRates(band, 0.06, T, Z, ne)
+    with pytest.raises(RuntimeError, match='column density'):
+        ctrate.getCountRatesDerivs(band, 0.005, T, Z, ne)
+
+    ctrate.cosmo = ctrate.cosmo.withRedshift(0.2)
+    with pytest.raises(RuntimeError, match='redshift'):
+        ctrate.getCountRates(band, 0.03, T, Z, ne)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Check analytic likelihood derivatives against finite differences."""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+import pytest
+
+import mbproj2 as mb
+from mbproj2.countrate import CountRate
+
+nshells = 12
+
+def makeFit(responses, psf=False, perannulus=False, **ctratekw):
+    cosmo = mb.Cosmology(0.1)
+    annuli = mb.Annuli(N.linspace(0.1, 4, nshells+1), cosmo)
+    for name, val in ctratekw.items():
+        setattr(annuli.ctrate, name, val)
+
+    ne = mb.CmptBeta('ne', annuli)
+    T = mb.CmptFlat('T', annuli, defval=0.5, log=True)
+    Z = mb.CmptFlat('Z', annuli, defval=0.3)
+    model = mb.ModelNullPot(annuli, ne, T, Z, NH_1022pcm2=0.03)
+
+    rs = N.random.RandomState(3)
+    psfmatrix = None
+    if psf:
+        psfmatrix = rs.rand(nshells, nshells)
+        psfmatrix /= psfmatrix.sum(axis=0)
+    rmf = responses['test.rmf']
+    if perannulus:
+        rmf = [rmf]*(nshells//2) + [responses['test2.rmf']]*(nshells-nshells//2)
+
+    bands = [
+        mb.Band(
+            emin, emax, rs.poisson(50, nshells).astype(float), rmf,
+            responses['test.arf'], 1e5, backrates=1e-5, psfmatrix=psfmatrix)
+        for emin, emax in ((0.5, 1.2), (1.2, 2.5), (2.5, 7.))]
+    return mb.Fit(model.defPars(), model, mb.Data(bands, annuli))
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'psf': True},
+    {'perannulus': True},
+    {'NHgrid_1022pcm2': [0.01, 0.05], 'zgrid': [0.05, 0.15]},
+    ], ids=['exact', 'psf', 'perannulus', 'gridded'])
+def test_likelihood_derivatives(emulator, responses, kwargs):
+    fit = makeFit(responses, **kwargs)
+
+    rs = N.random.RandomState(1)
+    profs = {
+        'ne': N.logspace(-1.5, -3, nshells),
+        'T': N.linspace(1.3, 7.7, nshells) + rs.rand(nshells)*0.1,
+        'Z': N.linspace(0.2, 0.5, nshells),
+        }
+    fit.model.computeProfs = lambda pars: (profs['ne'], profs['T'], profs['Z'])
+
+    like, derivs = fit.calcLikeProfileDerivs()
+    assert like == pytest.approx(fit.likeFromProfs(fit.calcProfiles()), abs=1e-9)
+
+    h = 1e-6
+    for name, prof, log in (
+            ('logne', 'ne', True), ('logT', 'T', True), ('Z', 'Z', False)):
+        orig = profs[prof]
+        for i in (0, nshells//2, nshells-1):
+            likes = []
+            for step in (h, -h):
+                vals = orig.copy()
+                if log:
+                    vals[i] *= N.exp(step)
+                else:
+                    vals[i] += step
+                profs[prof] = vals
+                likes.append(fit.likeFromProfs(fit.calcProfiles()))
+            profs[prof] = orig
+            numeric = (likes[0]-likes[1]) / (2*h)
+            assert derivs[name][i] == pytest.approx(numeric, rel=1e-5, abs=1e-3)
+
+def test_adaptive_derivatives(emulator, responses, monkeypatch):
+    monkeypatch.setattr(CountRate, 'Ttolerance', 1e-3)
+    test_likelihood_derivatives(emulator, responses, {})
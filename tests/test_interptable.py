@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Compare interpolating tables with scipy."""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+import pytest
+import scipy.interpolate
+
+from mbproj2 import interptable
+
+rs = N.random.RandomState(2)
+values = N.vstack([N.sin(N.linspace(0, 3, 25)), rs.rand(25)])
+xeval = N.concatenate([rs.uniform(-0.5, 2.5, 200), [0., 2., 1.]])
+
+def uniformReference(kind):
+    x = N.linspace(0., 2., 25)
+    if kind == 'linear':
+        return scipy.interpolate.interp1d(x, values, axis=-1)
+    else:
+        return scipy.interpolate.CubicSpline(x, values, axis=-1)
+
+@pytest.mark.parametrize('kind', ['linear', 'cubic'])
+def test_uniform(kind):
+    table = interptable.UniformGridTable(0., 2., values, kind=kind)
+    ref = uniformReference(kind)
+    # values outside the grid are clipped
+    clipped = N.clip(xeval, 0., 2.)
+    assert N.allclose(table(xeval), ref(clipped), rtol=1e-10, atol=1e-12)
+
+def nonUniformGrid():
+    x = N.cumsum(N.random.RandomState(3).uniform(0.01, 0.2, 25))
+    return 2*(x-x[0])/(x[-1]-x[0])
+
+def test_nonuniform():
+    x = nonUniformGrid()
+    table = interptable.makeGridTable(x, values)
+    assert isinstance(table, interptable.NonUniformGridTable)
+    ref = scipy.interpolate.interp1d(x, values, axis=-1)
+    clipped = N.clip(xeval, 0., 2.)
+    assert N.allclose(table(xeval), ref(clipped), rtol=1e-10, atol=1e-12)
+
+    # exactly on the grid points
+    assert N.allclose(table(x), values, rtol=1e-12, atol=1e-12)
+
+@pytest.mark.parametrize('kind', ['linear', 'cubic'])
+def test_uniform_derivative(kind):
+    table = interptable.UniformGridTable(0., 2., values, kind=kind)
+    ref = uniformReference(kind)
+    clipped = N.clip(xeval, 0., 2.)
+    vals, derivs = table.valueAndDerivative(clipped)
+    assert N.allclose(vals, ref(clipped), rtol=1e-10, atol=1e-12)
+    if kind == 'cubic':
+        assert N.allclose(derivs, ref(clipped, 1), rtol=1e-8, atol=1e-10)
+
+def test_nonuniform_derivative():
+    x = nonUniformGrid()
+    table = interptable.makeGridTable(x, values)
+
+    # derivatives are the slopes of the intervals, zero outside the grid
+    inside = (xeval > 0) & (xeval < 2)
+    idx = N.searchsorted(x, xeval[inside]) - 1
+    slopes = N.diff(values, axis=-1) / N.diff(x)
+    derivs = table.valueAndDerivative(xeval)[1]
+    assert N.allclose(derivs[:, inside], slopes[:, idx])
+    outside = (xeval < 0) | (xeval > 2)
+    assert N.all(derivs[:, outside] == 0)
+
+def test_float32():
+    table = interptable.makeGridTable(N.linspace(0, 2, 25), values)
+    single = table.astype(N.float32)
+    vals, derivs = single.valueAndDerivative(xeval)
+    assert vals.dtype == N.float32 and derivs.dtype == N.float32
+    assert N.allclose(vals, table(xeval), rtol=1e-5, atol=1e-6)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Check the Cash likelihood against the direct Cash statistic."""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+from scipy.special import gammaln
+
+from mbproj2 import utils
+
+def directCash(data, model):
+    return N.sum(data*N.log(model) - model - gammaln(data+1))
+
+rs = N.random.RandomState(4)
+model = rs.uniform(0.1, 20., (3, 40))
+data = rs.poisson(model).astype(float)
+
+def test_gradient():
+    grad = utils.cashLogLikelihoodGrad(data, model)
+    h = 1e-6
+    for i, j in ((0, 0), (1, 7), (2, 39)):
+        up = model.copy()
+        up[i, j] += h
+        down = model.copy()
+        down[i, j] -= h
+        numeric = (directCash(data, up) - directCash(data, down)) / (2*h)
+        assert N.isclose(grad[i, j], numeric, rtol=1e-5, atol=1e-7)
+
+def test_values():
+    # some bins have no counts
+    assert N.any(data == 0)
+    like = utils.CashLikelihood(data)
+    assert N.isclose(like(model), directCash(data, model), rtol=1e-12)
+    assert N.isclose(
+        utils.cashLogLikelihood(data, model), directCash(data, model),
+        rtol=1e-12)
+
+    # all bins with counts
+    data1 = data + 1
+    assert N.isclose(
+        utils.CashLikelihood(data1)(model), directCash(data1, model),
+        rtol=1e-12)
+
+def test_float32():
+    like = utils.CashLikelihood(data)
+    assert N.isclose(
+        like(model.astype(N.float32)), directCash(data, model), rtol=1e-6)
+
+def test_zero_counts():
+    like = utils.CashLikelihood(data)
+    zero = data == 0
+
+    # zero model in bins without counts is allowed
+    m = model.copy()
+    m[zero] = 0
+    assert N.isclose(like(m), directCash(data[~zero], m[~zero]), rtol=1e-12)
+
+    # invalid models
+    m[zero] = -1
+    assert like(m) == -N.inf
+    m = model.copy()
+    m[~zero] = 0
+    with N.errstate(divide='ignore'):
+        assert like(m) == -N.inf
+    m = model.copy()
+    m[0, 0] = N.nan
+    assert like(m) == -N.inf
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Check the projection operators against the dense matrix."""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+import pytest
+
+from mbproj2 import projection, utils
+
+# (in units where the volumes fit in single precision)
+radii = N.concatenate([[0.], N.cumsum(N.linspace(1., 3., 30))])
+
+def bandedMatrix(bandwidth):
+    """Dense projection matrix, optionally keeping only shells up to
+    bandwidth outside each annulus."""
+    dense = utils.projectionVolumeMatrix(radii)
+    if bandwidth is not None:
+        dense = N.triu(N.tril(dense, bandwidth))
+    return dense
+
+def test_dense_matrix():
+    m = utils.projectionVolumeMatrix(radii)
+    assert N.allclose(projection.DenseProjection(radii).toarray(), m)
+    # each shell projects only onto annuli inside it
+    assert N.all(N.tril(m, -1) == 0)
+    # total volume of each shell is spread over the annuli
+    vols = 4/3*N.pi*(radii[1:]**3-radii[:-1]**3)
+    assert N.allclose(m.sum(axis=0), vols, rtol=1e-10)
+
+@pytest.mark.parametrize('bandwidth', [None, 0, 3, 100])
+def test_triangular(bandwidth):
+    dense = bandedMatrix(bandwidth)
+    op = projection.makeProjection(
+        radii, kind='triangular', bandwidth=bandwidth)
+    assert N.allclose(op.toarray(), dense, rtol=1e-12, atol=0)
+
+    rs = N.random.RandomState(1)
+    emiss = rs.rand(len(radii)-1)
+    assert N.allclose(op.dot(emiss), dense.dot(emiss), rtol=1e-10, atol=0)
+    assert N.allclose(op.dotT(emiss), dense.T.dot(emiss), rtol=1e-10, atol=0)
+
+    block = rs.rand(len(radii)-1, 3)
+    assert N.allclose(op.dot(block), dense.dot(block), rtol=1e-10, atol=0)
+
+def test_unknown_projection():
+    with pytest.raises(RuntimeError):
+        projection.makeProjection(radii, kind='unknown')
+
+@pytest.mark.parametrize('bandwidth', [None, 3])
+def test_row_scaled(bandwidth):
+    scale = N.linspace(0.5, 2., len(radii)-1)
+    dense = bandedMatrix(bandwidth) * scale[:, N.newaxis]
+    op = projection.TriangularProjection(
+        radii, bandwidth=bandwidth).rowScaled(scale)
+    assert N.allclose(op.toarray(), dense, rtol=1e-12, atol=0)
+    emiss = N.random.RandomState(5).rand(len(radii)-1)
+    assert N.allclose(op.dot(emiss), dense.dot(emiss), rtol=1e-10, atol=0)
+
+def test_rectangular():
+    # shells every second annulus edge
+    shellradii = radii[::2]
+    op = projection.makeProjection(radii, shellradii_cm=shellradii)
+    assert op.toarray().shape == (len(radii)-1, len(shellradii)-1)
+
+    # emission constant within each shell gives the same result as
+    # projecting with the fine shells
+    emiss = N.linspace(3., 1., len(shellradii)-1)
+    fine = projection.makeProjection(radii).dot(N.repeat(emiss, 2))
+    assert N.allclose(op.dot(emiss), fine, rtol=1e-10)
+
+@pytest.mark.parametrize('bandwidth', [None, 3])
+def test_triangular_float32(bandwidth):
+    dense = bandedMatrix(bandwidth).astype(N.float32)
+    op = projection.TriangularProjection(
+        radii, bandwidth=bandwidth).astype(N.float32)
+    assert N.allclose(op.toarray(), dense, rtol=1e-6, atol=0)
+
+    rs = N.random.RandomState(1)
+    emiss = rs.rand(len(radii)-1).astype(N.float32)
+    out = op.dot(emiss)
+    assert out.dtype == N.float32
+    assert N.allclose(out, dense.dot(emiss), rtol=1e-5, atol=0)
+    assert N.allclose(op.dotT(emiss), dense.T.dot(emiss), rtol=1e-5, atol=0)
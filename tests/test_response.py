@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Check the precomposed band response operators."""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+import pytest
+
+import mbproj2 as mb
+
+nannuli = 20
+
+def makeData(psf):
+    annuli = mb.Annuli(
+        N.linspace(0.1, 4, nannuli+1), mb.Cosmology(0.1),
+        projection='triangular')
+    rs = N.random.RandomState(7)
+    psfmatrix = None
+    if psf:
+        psfmatrix = rs.rand(nannuli, nannuli)
+        psfmatrix /= psfmatrix.sum(axis=0)
+    bands = [
+        mb.Band(
+            emin, emax, rs.poisson(50, nannuli).astype(float),
+            'test.rmf', 'test.arf', rs.uniform(1e4, 1e5, nannuli),
+            backrates=rs.uniform(1e-5, 2e-5, nannuli),
+            areascales=rs.uniform(0.9, 1.1, nannuli), psfmatrix=psfmatrix)
+        for emin, emax in ((0.5, 1.2), (1.2, 2.5))]
+    return mb.Data(bands, annuli)
+
+def expected(band, annuli, rates):
+    matrix = annuli.projector.toarray()
+    if band.psfmatrix is not None:
+        matrix = band.psfmatrix.dot(matrix)
+    scale = band.areascales * band.exposures
+    return (
+        matrix.dot(rates) * scale,
+        band.backrates * annuli.geomarea_arcmin2 * scale)
+
+@pytest.mark.parametrize('psf', [False, True], ids=['nopsf', 'psf'])
+def test_changed_in_place(psf):
+    data = makeData(psf)
+    annuli = data.annuli
+    rates = N.random.RandomState(8).uniform(
+        1e-70, 1e-69, (len(data.bands), nannuli))
+
+    def check():
+        clust, back = data.projectCountRates(rates)
+        for i, band in enumerate(data.bands):
+            c, b = expected(band, annuli, rates[i])
+            assert N.allclose(clust[i], c, rtol=1e-10, atol=0)
+            assert N.allclose(back[i], b, rtol=1e-10, atol=0)
+            c, b = band.projectCountRates(annuli, rates[i])
+            assert N.allclose(c, expected(band, annuli, rates[i])[0],
+                              rtol=1e-10, atol=0)
+
+    check()
+    band = data.bands[0]
+    band.exposures[:] *= 2
+    check()
+    band.areascales[3] = 0.5
+    check()
+    band.backrates[:] = 3e-5
+    check()
+    if psf:
+        band.psfmatrix[:] = N.eye(nannuli)
+        check()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Check projecting the stacked bands together against each band."""
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as N
+import pytest
+
+import mbproj2 as mb
+from mbproj2.countrate import CountRate
+
+@pytest.mark.parametrize('projection', ['dense', 'triangular'])
+@pytest.mark.parametrize('dtype', [N.float64, N.float32])
+def test_stacked_projection(projection, dtype):
+    nannuli = 40
+    annuli = mb.Annuli(
+        N.linspace(0.1, 4, nannuli+1), mb.Cosmology(0.1),
+        projection=projection)
+    rs = N.random.RandomState(6)
+    bands = [
+        mb.Band(
+            emin, emax, rs.poisson(50, nannuli).astype(float),
+            'test.rmf', 'test.arf', rs.uniform(1e4, 1e5, nannuli),
+            backrates=1e-5, areascales=rs.uniform(0.9, 1.1, nannuli))
+        for emin, emax in ((0.5, 1.2), (1.2, 2.5), (2.5, 7.))]
+    data = mb.Data(bands, annuli, dtype=dtype)
+
+    # count rates per cm3 (or per float32volume_cm3 in single precision)
+    rates = rs.uniform(1e-70, 1e-69, (len(bands), nannuli))
+    if dtype is N.float32:
+        rates *= CountRate.float32volume_cm3
+    rates = rates.astype(dtype)
+
+    clust, back = data.projectCountRates(rates, backscale=1.5)
+    assert clust.dtype == dtype and back.dtype == dtype
+    if projection == 'triangular':
+        # the dense matrix is not needed
+        assert annuli.projector._dense is None
+
+    for i, band in enumerate(bands):
+        c, b = band.projectCountRates(annuli, rates[i], backscale=1.5)
+        assert N.allclose(clust[i], c, rtol=1e-5, atol=0)
+        assert N.allclose(back[i], b, rtol=1e-5, atol=0)
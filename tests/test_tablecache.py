@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016 Jeremy Sanders <jeremy@jeremysanders.net>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the Free
+# Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA
+
+"""Round trips through the table cache, bundles and memory cache."""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+
+import numpy as N
+import pytest
+
+from mbproj2 import tablecache
+
+def makeTable(i):
+    return {'logT': N.linspace(-1, 2, 50), 'rates': N.full((2, 50), float(i))}
+
+def test_put_get(tmp_path):
+    cache = tablecache.TableCache(str(tmp_path))
+    key = tablecache.hashKey(['test', 1.5, N.arange(3)])
+    assert cache.get(key) is None
+
+    cache.put(key, makeTable(1))
+    table = cache.get(key)
+    assert N.all(table['rates'] == 1.)
+    assert N.all(table['logT'] == makeTable(1)['logT'])
+
+def test_hash_key():
+    assert tablecache.hashKey([1, 'a']) == tablecache.hashKey([1, 'a'])
+    assert tablecache.hashKey([1, 'a']) != tablecache.hashKey([1, 'b'])
+    # array type and shape are part of the key
+    assert (tablecache.hashKey([N.zeros(4)]) !=
+            tablecache.hashKey([N.zeros((2, 2))]))
+    assert (tablecache.hashKey([N.zeros(4)]) !=
+            tablecache.hashKey([N.zeros(4, dtype=N.float32)]))
+
+def test_evict(tmp_path):
+    cache = tablecache.TableCache(str(tmp_path), maxsize_bytes=None)
+    keys = [tablecache.hashKey(['evict', i]) for i in range(4)]
+    for i, key in enumerate(keys):
+        cache.put(key, makeTable(i))
+        # order the entries by use
+        os.utime(cache.filename(key), (1000+i, 1000+i))
+    size = os.path.getsize(cache.filename(keys[0]))
+
+    # room for two tables, so the least recently used go
+    cache.maxsize_bytes = int(size*2.5)
+    cache.evict()
+    assert [os.path.exists(cache.filename(k)) for k in keys] == [
+        False, False, True, True]
+
+def test_bundle(tmp_path):
+    cache = tablecache.TableCache(str(tmp_path / 'cache'))
+    keys = [tablecache.hashKey(['bundle', i]) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, makeTable(i), meta={'kind': 'test', 'index': i})
+    assert cache.contains(keys[0])
+
+    bundlename = str(tmp_path / 'tables.npz')
+    cache.exportBundle(bundlename, keys[:2])
+    with pytest.raises(RuntimeError):
+        cache.exportBundle(str(tmp_path / 'bad.npz'), ['missing'])
+
+    offline = tablecache.TableCache(str(tmp_path / 'empty'))
+    offline.mountBundle(bundlename)
+    assert offline.offline
+    for i, key in enumerate(keys[:2]):
+        table = offline.get(key)
+        assert N.all(table['rates'] == i)
+        assert N.all(table['logT'] == makeTable(i)['logT'])
+    assert offline.get(keys[2]) is None
+
+    bundle = tablecache.TableBundle(bundlename)
+    assert sorted(t['meta']['index'] for t in bundle.manifest['tables']) == [0, 1]
+
+    with pytest.raises(tablecache.MissingTablesError):
+        offline.checkCanCompute([{'kind': 'test', 'index': 2}])
+
+def test_not_bundle(tmp_path):
+    filename = str(tmp_path / 'other.npz')
+    N.savez(filename, a=N.arange(3))
+    with pytest.raises(RuntimeError, match='Not an mbproj2 table bundle'):
+        tablecache.TableBundle(filename)
+
+def test_memory_cache():
+    table = makeTable(0)
+    size = tablecache.tableSize(table)
+    cache = tablecache.MemoryCache(maxsize_bytes=int(size*2.5))
+    cache.put('a', table)
+    cache.put('b', makeTable(1))
+    assert cache.get('a') is table
+    # b is now the least recently used
+    cache.put('c', makeTable(2))
+    assert cache.contains('a') and cache.contains('c')
+    assert not cache.contains('b')
+    assert cache.get('b') is None
+
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+    assert stats['evictions'] == 1 and stats['tables'] == 2